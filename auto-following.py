@@ -1,175 +1,955 @@
 '''Автоматическое повторение сделок у брокера Т-Банк'''
 import os
+import sys
 from dotenv import load_dotenv
 import pandas as pd
 import time
 import platform
 import numpy as np
-import math
+import threading
+import json
+import bisect
+import random
+from datetime import datetime, timedelta, timezone
+from contextlib import ExitStack, contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, Future
 
-from tinkoff.invest import Client, SecurityTradingStatus, Account
+import grpc
+
+from tinkoff.invest import Client, SecurityTradingStatus, Account, RequestError
 from tinkoff.invest import OrderExecutionReportStatus, OrderType, OrderDirection
-from tinkoff.invest.services import InstrumentsService
+from tinkoff.invest import InstrumentIdType
 from tinkoff.invest.utils import quotation_to_decimal
 
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
+# Файл со списком целевых счетов (JSON), заменяет TOKEN_TARGET и ratio_account
+targets_file = os.environ.get("targets_file") or None
 # Получение токенов из конфигурационного файла
 TOKEN_SOURCE = os.environ["TOKEN_SOURCE"]
-TOKEN_TARGET = os.environ["TOKEN_TARGET"]
 # Период обновления сравнения
 period_reload = int(os.environ["period_reload"])
-# Коэффициент пересчета размера позиций
-ratio_account = float(os.environ["ratio_account"])
+# Токен целевого счета и коэффициент пересчета размера позиций
+# обязательны, если не задан файл целевых счетов
+if targets_file is None:
+    TOKEN_TARGET = os.environ["TOKEN_TARGET"]
+    ratio_account = float(os.environ["ratio_account"])
+else:
+    TOKEN_TARGET = None
+    ratio_account = None
+# Режим повтора по событиям стрима позиций исходного счета (1 - включен)
+stream_mode = os.environ.get("stream_mode", "0") == "1"
+# Период принудительной сверки счетов в режиме стрима
+period_resync = int(os.environ.get("period_resync", "60"))
+# Адрес сервера API (по умолчанию - боевой контур брокера)
+invest_target = os.environ.get("invest_target") or None
+# Файл кэша справочника инструментов и срок актуальности записей в часах
+catalog_path = os.environ.get("catalog_path",
+                              os.path.join(os.path.dirname(__file__), 'instruments.npy'))
+catalog_ttl = float(os.environ.get("catalog_ttl", "24"))
+# Количество параллельно отправляемых заявок
+deal_workers = int(os.environ.get("deal_workers", "8"))
+# Ограничения частоты запросов к сервисам заявок, рыночных данных
+# и инструментов (в секунду)
+orders_rate = float(os.environ.get("orders_rate", "5"))
+market_data_rate = float(os.environ.get("market_data_rate", "10"))
+instruments_rate = float(os.environ.get("instruments_rate", "3"))
+# Срок актуальности статуса торговли инструментом в секундах
+status_ttl = float(os.environ.get("status_ttl", "2"))
+# Порт HTTP для экспорта метрик в формате Prometheus (по умолчанию выключен)
+metrics_port = int(os.environ.get("metrics_port", "0"))
+# Файл журнала метрик циклов в формате JSON Lines (по умолчанию выключен)
+metrics_log = os.environ.get("metrics_log") or None
+# Период полного считывания позиций целевого счета, в промежутках состав
+# целевого счета рассчитывается по отчетам об исполнении заявок
+period_full_resync = int(os.environ.get("period_full_resync", "60"))
+# Интервал опроса вне торговых сессий в секундах
+period_closed = int(os.environ.get("period_closed", "300"))
+# Интервал опроса, когда закрыты биржи инструментов на счетах, но открыты
+# другие биржи (исходный счет может открыть позицию на другой бирже)
+period_other_open = int(os.environ.get("period_other_open", "30"))
+# Начальная и максимальная задержка переподключения при ошибках в секундах
+reconnect_base = float(os.environ.get("reconnect_base", "1"))
+reconnect_max = float(os.environ.get("reconnect_max", "60"))
+# Режим вывода: screen - очистка и вывод экрана целиком, incremental - перерисовка
+# изменившихся строк, headless - без экрана, только события о заданиях
+display_mode = os.environ.get("display_mode", "screen")
+# Количество повторных сверок подряд без ожидания после исполнения заявок
+repeat_limit = int(os.environ.get("repeat_limit", "3"))
 # Определение команды для очистки экрана
 clr_command = 'cls' if platform.system() == 'Windows' else 'clear'
 
-def main():
+class InstrumentCatalog:
+    ''' Справочник инструментов с хранением на диске. Записи хранятся
+        в колоночном файле numpy, который отображается в память при первом
+        обращении. Инструменты, отсутствующие в файле, запрашиваются у API
+        по figi и дописываются в файл, поэтому справочник содержит только
+        инструменты, встречавшиеся в счетах. Записи с истекшим сроком
+        актуальности используются до обновления, которое выполняется
+        в фоновом потоке. Прочитанные записи хранятся в памяти в виде
+        pandas.DataFrame с индексом figi, к файлу и API справочник
+        обращается только за отсутствующими в памяти записями.
+
+       Args:
+        path (str): путь к файлу справочника
+        ttl (float): срок актуальности записи в часах
+    '''
+
+    # Соответствие типа инструмента методу InstrumentsService
+    types = {'share': 'shares', 'bond': 'bonds', 'etf': 'etfs',
+             'currency': 'currencies', 'futures': 'futures'}
+    # Поля, хранящиеся в файле в строковом виде и восстанавливаемые в Decimal
+    decimal_fields = ['min_price_increment', 'klong', 'kshort']
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl * 3600
+        # Записи файла (отображение в память), загружаются при первом обращении
+        self._records = None
+        # Записи, полученные от API после загрузки файла
+        self._fresh = {}
+        # Записи, готовые к использованию (поля Decimal восстановлены)
+        self._resolved = pd.DataFrame(columns=self._columns()).set_index('figi')
+        # figi, не найденные в API (например, коды валют)
+        self._missing = set()
+        # Выполняющиеся запросы к API: {figi: Future}, каждый figi
+        # запрашивается одним потоком, остальные ожидают результат
+        self._inflight = {}
+        # Справочник используется параллельно для нескольких целевых счетов,
+        # блокировка не удерживается во время запросов к API
+        self._lock = threading.Lock()
+
+    def lookup(self, client: Client, figis, limiter: 'TokenBucket' = None) -> pd.DataFrame:
+        ''' Функция получения сведений об инструментах, данные возвращаются
+            в формате pandas.DataFrame с индексом figi. Отсутствующие записи
+            запрашиваются у API, устаревшие возвращаются сразу и обновляются
+            в фоновом потоке.
+
+           Args:
+            client (tinkoff.invest.Client): клиент подключения TINKOFF INVEST API.
+            figis (iterable): список figi
+            limiter (TokenBucket): ограничитель частоты запросов токена клиента
+
+            Returns:
+                pd.DataFrame: словарь инструментов
+        '''
+
+        index = pd.Index(pd.unique(np.asarray(list(figis), dtype=object)), name='figi')
+        now = time.time()
+        with self._lock:
+            # Записи, отсутствующие в памяти, читаются из файла
+            unknown = [figi for figi in index[~index.isin(self._resolved.index)]
+                       if figi not in self._missing]
+            if unknown:
+                df_read = self._read(unknown)
+                if df_read is not None:
+                    self._resolve(df_read)
+            resolved = self._resolved
+            absent = [figi for figi in unknown if figi not in resolved.index]
+            known = index[index.isin(resolved.index)]
+            expired = known[resolved.loc[known, 'fetched'].to_numpy(dtype=float) < now - self.ttl]
+            # Записи, уже запрашиваемые другими потоками, не запрашиваются повторно
+            waiting = [self._inflight[figi] for figi in absent if figi in self._inflight]
+            own = self._claim(absent)
+            stale = self._claim(expired)
+        if stale:
+            threading.Thread(target=self._refresh, args=(client, stale, limiter, now),
+                             daemon=True).start()
+        if own:
+            self._fetch_all(client, own, limiter, now)
+        for future in waiting:
+            # Ошибка запроса другого потока передается дальше
+            future.result()
+        with self._lock:
+            resolved = self._resolved
+        known = index[index.isin(resolved.index)]
+        return resolved.loc[known].drop(columns='fetched')
+
+    def _claim(self, figis) -> list:
+        # Регистрация запросов figi, вызывается под блокировкой
+        claimed = [figi for figi in figis if figi not in self._inflight]
+        for figi in claimed:
+            self._inflight[figi] = Future()
+        return claimed
+
+    def _fetch_all(self, client: Client, figis: list,
+                   limiter: 'TokenBucket', now: float) -> None:
+        # Запрос записей у API, после первой ошибки остальные запросы
+        # не выполняются, ошибка передается ожидающим потокам
+        rows, missing, error = [], [], None
+        try:
+            for figi in figis:
+                if limiter is not None:
+                    limiter.acquire()
+                row = self._fetch(client, figi, now)
+                if row is None:
+                    missing.append(figi)
+                else:
+                    rows.append(row)
+        except Exception as e:
+            error = e
+        with self._lock:
+            try:
+                self._missing.update(missing)
+                if rows:
+                    for row in rows:
+                        self._fresh[row['figi']] = row
+                    self._resolve(pd.DataFrame(rows, columns=self._columns()))
+                    self.save()
+            finally:
+                # Ожидающие потоки освобождаются в любом случае
+                done = {row['figi'] for row in rows}.union(missing)
+                for figi in figis:
+                    future = self._inflight.pop(figi)
+                    if figi in done:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+        if error is not None:
+            raise error
+
+    def _refresh(self, client: Client, figis: list,
+                 limiter: 'TokenBucket', now: float) -> None:
+        # Фоновое обновление устаревших записей, при ошибке
+        # устаревшие записи используются до следующей попытки
+        try:
+            self._fetch_all(client, figis, limiter, now)
+        except Exception as e:
+            metrics.inc('catalog_refresh_errors_total')
+            print(f'Ошибка обновления справочника инструментов: {e}', file=sys.stderr, flush=True)
+
+    def save(self) -> None:
+        ''' Функция записи справочника на диск. Новые записи объединяются
+            с имеющимися, файл заменяется атомарно.
+        '''
+
+        if not self._fresh:
+            return
+        records = self._load()
+        df_records = pd.DataFrame(list(self._fresh.values()), columns=self._columns())
+        if records.shape[0] > 0:
+            df_saved = pd.DataFrame(np.array(records))
+            df_records = pd.concat([df_saved[~df_saved['figi'].isin(self._fresh.keys())],
+                                    df_records],
+                                   ignore_index=True)
+        df_records = df_records.sort_values(by='figi')
+        # Строковые поля сохраняются с фиксированной шириной для отображения в память
+        column_dtypes = {name: f'U{max(1, int(df_records[name].astype(str).str.len().max()))}'
+                         for name in df_records.columns
+                         if df_records[name].dtype == object}
+        data = df_records.to_records(index=False, column_dtypes=column_dtypes)
+        # Файл, отображенный в память, освобождается до замены
+        self._records = None
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(data))
+        os.replace(tmp_path, self.path)
+        self._fresh = {}
+
+    def _load(self) -> np.ndarray:
+        if self._records is None:
+            if os.path.exists(self.path):
+                self._records = np.load(self.path, mmap_mode='r')
+            else:
+                self._records = np.empty(0, dtype=[('figi', 'U1')])
+        return self._records
+
+    def _read(self, figis: list) -> pd.DataFrame:
+        # Поиск записей в отсортированном по figi файле
+        records = self._load()
+        if records.shape[0] == 0:
+            return None
+        keys = np.array(figis, dtype=str)
+        i = np.minimum(np.searchsorted(records['figi'], keys), records.shape[0] - 1)
+        i = i[records['figi'][i] == keys]
+        if i.shape[0] == 0:
+            return None
+        return pd.DataFrame(np.array(records[i]))
+
+    def _resolve(self, df_rows: pd.DataFrame) -> None:
+        # Таблица записей заменяется целиком, ранее выданные ссылки не изменяются
+        df_rows = df_rows.set_index('figi')
+        for name in self.decimal_fields:
+            df_rows[name] = df_rows[name].map(Decimal)
+        resolved = self._resolved[~self._resolved.index.isin(df_rows.index)]
+        self._resolved = pd.concat([resolved, df_rows]) if resolved.shape[0] > 0 else df_rows
+
+    def _columns(self) -> list:
+        return ['figi', 'name', 'ticker', 'class_code', 'uid', 'type',
+                'min_price_increment', 'scale', 'lot', 'trading_status',
+                'api_trade_available_flag', 'currency', 'exchange',
+                'buy_available_flag', 'sell_available_flag', 'short_enabled_flag',
+                'klong', 'kshort', 'fetched']
+
+    def _fetch(self, client: Client, figi: str, now: float) -> dict:
+        try:
+            item = client.instruments.get_instrument_by(
+                id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI, id=figi
+            ).instrument
+        except RequestError as e:
+            # Отсутствующим считается только инструмент, не найденный в API,
+            # остальные ошибки передаются дальше
+            if e.code == grpc.StatusCode.NOT_FOUND:
+                return None
+            raise
+        return {
+            "figi": item.figi,
+            "name": item.name,
+            "ticker": item.ticker,
+            "class_code": item.class_code,
+            "uid": item.uid,
+            "type": self.types.get(item.instrument_type, item.instrument_type),
+            "min_price_increment": str(quotation_to_decimal(item.min_price_increment)),
+            "scale": 9 - len(str(item.min_price_increment.nano)) + 1,
+            "lot": item.lot,
+            "trading_status": str(SecurityTradingStatus(item.trading_status).name),
+            "api_trade_available_flag": item.api_trade_available_flag,
+            "currency": item.currency,
+            "exchange": item.exchange,
+            "buy_available_flag": item.buy_available_flag,
+            "sell_available_flag": item.sell_available_flag,
+            "short_enabled_flag": item.short_enabled_flag,
+            "klong": str(quotation_to_decimal(item.klong)),
+            "kshort": str(quotation_to_decimal(item.kshort)),
+            "fetched": now,
+        }
+
+
+# Справочник инструментов сохраняется между перезапусками main()
+catalog = InstrumentCatalog(catalog_path, catalog_ttl)
+
+
+class PortfolioSnapshot:
+    ''' Состав счета в виде массивов numpy в порядке ответа get_positions:
+        id (figi или код валюты), тип позиции и количество. Количество
+        ценных бумаг и фьючерсов - целое число штук, денежные остатки
+        хранятся в фиксированной точке с шагом 1e-9. Преобразование
+        в pandas.DataFrame выполняется только для вывода.
+
+       Args:
+        ids (np.ndarray): id позиций
+        kinds (np.ndarray): типы позиций (SECURITY, FUTURE, MONEY)
+        quantity (np.ndarray): количество
+    '''
+
+    __slots__ = ('ids', 'kinds', 'quantity')
+
+    # Типы позиций и их наименования для вывода
+    SECURITY, FUTURE, MONEY = 0, 1, 2
+    kind_names = np.array(['Акции, фонды', 'Фьючерсы', 'Валюта'], dtype=object)
+    # Множитель фиксированной точки денежных остатков
+    money_scale = 10**9
+
+    def __init__(self, ids: np.ndarray, kinds: np.ndarray, quantity: np.ndarray):
+        self.ids = ids
+        self.kinds = kinds
+        self.quantity = quantity
+
+    @classmethod
+    def from_positions(cls, positions) -> 'PortfolioSnapshot':
+        ''' Функция построения состава счета за один проход по ответу
+            get_positions.
+
+           Args:
+            positions (tinkoff.invest.PositionsResponse): позиции счета
+
+            Returns:
+                PortfolioSnapshot: состав счета
+        '''
+
+        n = len(positions.securities) + len(positions.futures) + len(positions.money)
+        ids = np.empty(n, dtype=object)
+        kinds = np.empty(n, dtype=np.int8)
+        quantity = np.empty(n, dtype=np.int64)
+        i = 0
+        for kind, items in ((cls.SECURITY, positions.securities), (cls.FUTURE, positions.futures)):
+            for pos in items:
+                ids[i], kinds[i], quantity[i] = pos.figi, kind, pos.balance
+                i += 1
+        for pos in positions.money:
+            ids[i], kinds[i] = pos.currency, cls.MONEY
+            quantity[i] = pos.units * cls.money_scale + pos.nano
+            i += 1
+        return cls(ids, kinds, quantity)
+
+    def figis(self) -> np.ndarray:
+        ''' Функция получения figi ценных бумаг и фьючерсов. '''
+
+        return self.ids[self.kinds != self.MONEY]
+
+    def amounts(self) -> np.ndarray:
+        ''' Функция получения количества в единицах актива. '''
+
+        amounts = self.quantity.astype(float)
+        money = self.kinds == self.MONEY
+        amounts[money] = self.quantity[money] / self.money_scale
+        return amounts
+
+    def types(self) -> np.ndarray:
+        ''' Функция получения наименований типов позиций. '''
+
+        return self.kind_names[self.kinds]
+
+    def to_dataframe(self, df_dict_instr: pd.DataFrame) -> pd.DataFrame:
+        ''' Функция преобразования состава счета для вывода, данные
+            возвращаются в формате pandas.DataFrame.
+
+           Args:
+            df_dict_instr (pd.DataFrame): словарь инструментов
+
+            Returns:
+                pd.DataFrame: список открытых позиций
+        '''
+
+        names = pd.Index(self.ids).map(df_dict_instr['name']).to_numpy(dtype=object)
+        missing = pd.isna(names)
+        names[missing] = self.ids[missing]
+        # Количество ценных бумаг - целое, денежных остатков - дробное
+        quantity = self.quantity.astype(object)
+        money = self.kinds == self.MONEY
+        quantity[money] = self.amounts()[money]
+        return pd.DataFrame({'id': self.ids,
+                             'Наименование': names,
+                             'Количество': quantity,
+                             'Тип актива': self.types()})
+
+    def apply_executions(self, executed: list, df_dict_instr: pd.DataFrame) -> 'PortfolioSnapshot':
+        ''' Функция расчета состава счета после исполнения заявок. Остатки
+            денежных средств не пересчитываются и уточняются при полном
+            считывании позиций.
+
+           Args:
+            executed (list): исполненные заявки (id, количество лотов со знаком,
+                             признак полного исполнения)
+            df_dict_instr (pd.DataFrame): словарь инструментов
+
+            Returns:
+                PortfolioSnapshot: состав счета после исполнения заявок
+        '''
+
+        if not executed:
+            return self
+        # Изменение количества активов по инструментам
+        delta = {}
+        for figi, lots, _ in executed:
+            delta[figi] = delta.get(figi, 0) + lots * int(df_dict_instr['lot'].get(figi, 1))
+        index = {figi: i for i, figi in enumerate(self.ids) if self.kinds[i] != self.MONEY}
+        quantity = self.quantity.copy()
+        new_ids, new_kinds, new_quantity = [], [], []
+        for figi, value in delta.items():
+            if figi in index:
+                quantity[index[figi]] += value
+            else:
+                # Новые позиции
+                new_ids.append(figi)
+                new_kinds.append(self.FUTURE if df_dict_instr['type'].get(figi) == 'futures'
+                                 else self.SECURITY)
+                new_quantity.append(value)
+        ids = np.concatenate([self.ids, np.array(new_ids, dtype=object)])
+        kinds = np.concatenate([self.kinds, np.array(new_kinds, dtype=np.int8)])
+        quantity = np.concatenate([quantity, np.array(new_quantity, dtype=np.int64)])
+        # Закрытые позиции
+        keep = (quantity != 0) | (kinds == self.MONEY)
+        return PortfolioSnapshot(ids[keep], kinds[keep], quantity[keep])
+
+
+def main(state: dict):
+    ''' Основной цикл сверки счетов.
+
+       Args:
+        state (dict): состояние, сохраняемое между переподключениями:
+                      ссылки на счета, составы целевых счетов, расписание торгов
+    '''
+
     # Подключение к счетам
-    with Client(TOKEN_SOURCE) as client_source, Client(TOKEN_TARGET) as client_target:
-        # Получение ссылок на счета
-        account_source = client_source.users.get_accounts().accounts[0]
-        account_target = client_target.users.get_accounts().accounts[0]
-        # Получение словаря инструментов figi-name
-        instruments: InstrumentsService = client_target.instruments
-        tickers = []
-        for method in ["shares", "bonds", "etfs", "currencies", "futures"]:
-            for item in getattr(instruments, method)().instruments:
-                tickers.append(
-                    {
-                        "name": item.name,
-                        "ticker": item.ticker,
-                        "class_code": item.class_code,
-                        "figi": item.figi,
-                        "uid": item.uid,
-                        "type": method,
-                        "min_price_increment": quotation_to_decimal(
-                            item.min_price_increment
-                        ),
-                        "scale": 9 - len(str(item.min_price_increment.nano)) + 1,
-                        "lot": item.lot,
-                        "trading_status": str(
-                            SecurityTradingStatus(item.trading_status).name
-                        ),
-                        "api_trade_available_flag": item.api_trade_available_flag,
-                        "currency": item.currency,
-                        "exchange": item.exchange,
-                        "buy_available_flag": item.buy_available_flag,
-                        "sell_available_flag": item.sell_available_flag,
-                        "short_enabled_flag": item.short_enabled_flag,
-                        "klong": quotation_to_decimal(item.klong),
-                        "kshort": quotation_to_decimal(item.kshort),
-                    }
-                )
-        df_dict_instr = pd.DataFrame(tickers)
-        df_dict_instr = df_dict_instr.set_index('figi')
-        
-        # Инициализация DataFrame для исходного и целевого счетов
-        df_account_source = pd.DataFrame(columns=['id', 'Наименование', 'Количество', 'Тип актива'])
-        df_account_target = pd.DataFrame(columns=['id', 'Наименование', 'Количество', 'Тип актива'])
+    with ExitStack() as stack:
+        client_source = stack.enter_context(Client(TOKEN_SOURCE, target=invest_target))
+        # Получение ссылки на исходный счет и списка целевых счетов
+        # только при первом подключении
+        if 'account_source' not in state:
+            state['account_source'] = client_source.users.get_accounts().accounts[0]
+            state['targets'] = load_targets()
+            # Ограничения частоты запросов API действуют на токен,
+            # счета одного токена используют общие ограничители
+            limits = {}
+            for target in state['targets']:
+                target['limits'] = limits.setdefault(target['token'], RateLimits())
+        account_source = state['account_source']
+        targets = state['targets']
+        # Подключение к целевым счетам и пулы потоков для отправки заявок.
+        # Ошибка подключения целевого счета не прерывает работу с остальными,
+        # ссылка на счет получается в цикле сверки
+        for target in targets:
+            try:
+                target['client'] = stack.enter_context(Client(target['token'], target=invest_target))
+                target['connect_error'] = None
+            except Exception as e:
+                target['client'], target['connect_error'] = None, e
+            target['pool'] = stack.enter_context(ThreadPoolExecutor(max_workers=deal_workers))
         # Маркер отображения
         was_printing = False
+        # Количество повторных сверок подряд без ожидания
+        repeats = 0
+        renderer = state.setdefault('renderer', IncrementalRenderer())
+        scheduler = state.setdefault('scheduler', SessionScheduler(period_closed, period_other_open))
+        # События изменения исходного счета и доступности стрима позиций
+        source_changed = SourceChange()
+        stream_alive = threading.Event()
+        if stream_mode:
+            # Потоки стримов останавливаются до закрытия подключения
+            watchers_stop = threading.Event()
+            stack.callback(watchers_stop.set)
+            start_source_watchers(client_source, account_source,
+                                  source_changed, stream_alive, watchers_stop)
+        # Целевые счета обрабатываются параллельно
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=len(targets)))
             
         while True:
-            # Очистка DataFrame
-            df_account_source.drop(df_account_source.index, inplace=True)
-            df_account_target.drop(df_account_source.index, inplace=True)
-            # Заполнение текущими данными
-            df_account_source = position_to_dataframe(client_source, 
-                                                      account_source,
-                                                      df_dict_instr)
-            df_account_target = position_to_dataframe(client_target, 
-                                                      account_target,
-                                                      df_dict_instr)
-            # Сравнение исходного и целевого счетов и вычисление разницы
-            df_for_buy, df_for_sell = get_account_difference(df_account_source,
-                                                             df_account_target,
-                                                             ratio_account,
-                                                             df_dict_instr)
-            # Выполнение заданий на покупку/продажу по рынку
-            df_not_sell = start_deal_tasks(client_target,
-                                           account_target,
-                                           df_for_sell,
-                                           False)
-            # Выполнение заданий на покупку/продажу по рынку
-            df_not_buy = start_deal_tasks(client_target,
-                                          account_target,
-                                          df_for_buy,
-                                          True)
-            # Считывание состояния целевого портфеля после выполнения заданий 
-            # на покупку/продажу перед выводом на экран
-            df_account_target.drop(df_account_source.index, inplace=True)
-            df_account_target = position_to_dataframe(client_target, 
-                                                      account_target,
-                                                      df_dict_instr)
-            # Если есть невыполненные задания на покупку/продажу - вывод на экран
-            if not was_printing \
-               or (df_not_buy.shape[0] > 0 or df_not_sell.shape[0] > 0) \
-               or (df_for_buy.shape[0] > 0 or df_for_sell.shape[0] > 0):
-                was_printing = True
-                if (df_not_buy.shape[0] > 0 or df_not_sell.shape[0] > 0) \
-                   or (df_for_buy.shape[0] > 0 or df_for_sell.shape[0] > 0):
-                       was_printing = False
-                # Очистка экрана
-                os.system(clr_command)
-                print('Исходный', '='*70)
-                print(df_account_source.sort_values(by=['Тип актива', 'Наименование'], ignore_index=True))
-                print('Целевой', '='*72)
-                print(df_account_target.sort_values(by=['Тип актива', 'Наименование'], ignore_index=True))
-                print('Невыполненные задания на покупку', '='*47)
-                print(df_not_buy if not df_not_buy.empty else 'отсутствуют')
-                print('Невыполненные задания на продажу', '='*47)
-                print(df_not_sell if not df_not_sell.empty else 'отсутствуют')
-            # Ожидание
-            time.sleep(period_reload)
-
-
-def position_to_dataframe(client: Client, 
-                          account: Account, 
-                          df_dict_instr: pd.DataFrame) -> pd.DataFrame:
-    ''' Функция получения списка открытых позиций, данные возвращаются 
-        в формате pandas.DataFrame.
-       
+            cycle_start = time.monotonic()
+            # Момент обнаружения изменения исходного счета для расчета отставания
+            detected_at = source_changed.changed_at or cycle_start
+            # Сброс события до считывания исходного счета, чтобы изменения,
+            # пришедшие во время сверки, вызвали повторную сверку
+            source_changed.clear()
+            timings = {}
+            # Исходный счет считывается один раз для всех целевых
+            with metrics.timer('stage_duration_seconds', timings, stage='source_fetch'):
+                account_source_snapshot = position_snapshot(client_source, account_source)
+            results = list(executor.map(lambda target: replicate_target(target, account_source_snapshot),
+                                        targets))
+            record_cycle_metrics(results, timings, detected_at, cycle_start)
+            # Ошибка по всем целевым счетам - переподключение
+            succeeded = [result for result in results if 'error' not in result]
+            if not succeeded:
+                raise results[0]['error']
+            state['cycles'] = state.get('cycles', 0) + 1
+            # Если есть невыполненные задания на покупку/продажу
+            # или ошибки по целевым счетам - вывод на экран
+            has_tasks = len(succeeded) < len(results) or any(
+                result['df_not_buy'].shape[0] > 0 or result['df_not_sell'].shape[0] > 0
+                or result['df_for_buy'].shape[0] > 0 or result['df_for_sell'].shape[0] > 0
+                for result in succeeded)
+            # Без вывода на экран - только события о заданиях
+            if display_mode == 'headless':
+                if has_tasks:
+                    emit_events(results)
+            elif not was_printing or has_tasks:
+                was_printing = not has_tasks
+                # Словарь инструментов целевого счета содержит и инструменты исходного
+                df_account_source = account_source_snapshot.to_dataframe(succeeded[0]['df_dict_instr'])
+                lines = screen_lines(df_account_source, targets, results)
+                if display_mode == 'incremental':
+                    renderer.render(lines)
+                else:
+                    # Очистка экрана
+                    os.system(clr_command)
+                    print('\n'.join(lines))
+            # После исполнения заявок - повторная сверка без ожидания,
+            # но не более repeat_limit раз подряд
+            if any(result['executed'] > 0 for result in results) and repeats < repeat_limit:
+                repeats += 1
+                continue
+            repeats = 0
+            # Биржи инструментов на счетах для определения торговых сессий
+            exchanges = set().union(*(result['df_dict_instr']['exchange'] for result in succeeded))
+            # Ожидание изменения исходного счета либо периодической сверки,
+            # при недоступности стрима - опрос с периодом period_reload.
+            # Вне торговых сессий период увеличивается
+            if stream_alive.is_set():
+                source_changed.wait(scheduler.delay(client_source, period_resync, exchanges))
+            else:
+                time.sleep(scheduler.delay(client_source, period_reload, exchanges))
+
+
+def screen_lines(df_account_source: pd.DataFrame,
+                 targets: list,
+                 results: list) -> list:
+    ''' Функция формирования строк экрана: состав исходного и целевых
+        счетов, невыполненные задания.
+
+       Args:
+        df_account_source (pd.DataFrame): состав исходного счета
+        targets (list): целевые счета
+        results (list): результаты replicate_target по целевым счетам
+
+        Returns:
+            list: строки экрана
+    '''
+
+    blocks = ['Исходный ' + '='*70,
+              str(df_account_source.sort_values(by=['Тип актива', 'Наименование'], ignore_index=True))]
+    for target, result in zip(targets, results):
+        title = f"Целевой {target['name']}" if target['name'] else 'Целевой'
+        if 'error' in result:
+            blocks += [title + ' ' + '='*max(0, 79 - len(title)),
+                       f"Ошибка: {result['error']}"]
+            continue
+        blocks += [title + ' ' + '='*max(0, 79 - len(title)),
+                   str(result['account_target'].to_dataframe(result['df_dict_instr'])
+                       .sort_values(by=['Тип актива', 'Наименование'], ignore_index=True)),
+                   'Невыполненные задания на покупку ' + '='*47,
+                   str(result['df_not_buy'] if not result['df_not_buy'].empty else 'отсутствуют'),
+                   'Невыполненные задания на продажу ' + '='*47,
+                   str(result['df_not_sell'] if not result['df_not_sell'].empty else 'отсутствуют')]
+    return '\n'.join(blocks).split('\n')
+
+
+def emit_events(results: list) -> None:
+    ''' Функция вывода событий о заданиях на покупку/продажу
+        в формате JSON Lines для режима без экрана.
+
+       Args:
+        results (list): результаты replicate_target по целевым счетам
+    '''
+
+    def records(df: pd.DataFrame) -> list:
+        return json.loads(df.to_json(orient='records', force_ascii=False))
+
+    for result in results:
+        if 'error' in result:
+            print(json.dumps({'ts': time.time(), 'event': 'error', 'target': result['target'],
+                              'error': str(result['error'])}, ensure_ascii=False), flush=True)
+            continue
+        event = {'ts': time.time(), 'event': 'tasks', 'target': result['target'],
+                 'buy': records(result['df_for_buy']),
+                 'sell': records(result['df_for_sell']),
+                 'not_buy': records(result['df_not_buy']),
+                 'not_sell': records(result['df_not_sell'])}
+        if any(event[key] for key in ('buy', 'sell', 'not_buy', 'not_sell')):
+            print(json.dumps(event, ensure_ascii=False), flush=True)
+
+
+class IncrementalRenderer:
+    ''' Вывод на экран с перерисовкой только изменившихся строк
+        управляющими последовательностями ANSI, без запуска команды
+        очистки экрана.
+    '''
+
+    def __init__(self):
+        self._lines = None
+
+    def render(self, lines: list) -> None:
+        ''' Функция вывода строк экрана.
+
+           Args:
+            lines (list): строки экрана
+        '''
+
+        out = []
+        if self._lines is None:
+            # Первый вывод - очистка экрана
+            out.append('\x1b[2J')
+            self._lines = []
+        for row, line in enumerate(lines):
+            if row >= len(self._lines) or self._lines[row] != line:
+                # Перемещение курсора в начало строки, вывод, очистка остатка строки
+                out.append(f'\x1b[{row + 1};1H{line}\x1b[K')
+        if len(lines) < len(self._lines):
+            # Очистка строк, оставшихся от предыдущего вывода
+            out.append(f'\x1b[{len(lines) + 1};1H\x1b[J')
+        # Курсор после последней строки
+        out.append(f'\x1b[{len(lines) + 1};1H')
+        sys.stdout.write(''.join(out))
+        sys.stdout.flush()
+        self._lines = list(lines)
+
+
+def load_targets() -> list:
+    ''' Функция получения списка целевых счетов. Если задан файл targets_file,
+        счета читаются из него, иначе используется единственный счет
+        из TOKEN_TARGET и ratio_account.
+
+        Returns:
+            list: целевые счета (token, account_id, ratio, name)
+    '''
+
+    if targets_file is None:
+        return [{'token': TOKEN_TARGET, 'account_id': None,
+                 'ratio': ratio_account, 'name': ''}]
+    with open(targets_file, encoding='utf-8') as f:
+        items = json.load(f)
+    if not items:
+        raise ValueError(f"Файл '{targets_file}' не содержит целевых счетов.")
+    return [{'token': item['token'],
+             'account_id': item.get('account_id'),
+             'ratio': float(item['ratio']),
+             'name': item.get('name', item.get('account_id') or '')}
+            for item in items]
+
+
+def get_account(client: Client, account_id: str = None) -> Account:
+    ''' Функция получения ссылки на счет по идентификатору,
+        при отсутствии идентификатора - первый счет.
+
+       Args:
+        client (tinkoff.invest.Client): клиент подключения TINKOFF INVEST API.
+        account_id (str): идентификатор счета
+
+        Returns:
+            tinkoff.invest.Account: счет TINKOFF INVEST API.
+    '''
+
+    accounts = client.users.get_accounts().accounts
+    if account_id is None:
+        return accounts[0]
+    for account in accounts:
+        if account.id == account_id:
+            return account
+    raise ValueError(f"Счет '{account_id}' не найден.")
+
+
+def replicate_target(target: dict, account_source: PortfolioSnapshot) -> dict:
+    ''' Функция повтора состава исходного счета на целевом счете
+        с изоляцией ошибок: ошибка по одному целевому счету не прерывает
+        обработку остальных, а возвращается в результате (error),
+        состав счета полностью считывается в следующем цикле.
+
+       Args:
+        target (dict): целевой счет (client, account, ratio)
+        account_source (PortfolioSnapshot): состав исходного счета
+
+        Returns:
+            dict: результат sync_target либо ошибка по целевому счету
+    '''
+
+    try:
+        return sync_target(target, account_source)
+    except Exception as e:
+        target['dirty'] = True
+        # Ссылка на счет может быть не получена из-за ошибки
+        label = target['account'].id if target.get('account') is not None \
+                else target.get('account_id') or target.get('name') or ''
+        metrics.inc('target_errors_total', target=label)
+        return {'target': label, 'error': e,
+                'timings': {}, 'executed': 0}
+
+
+def sync_target(target: dict, account_source: PortfolioSnapshot) -> dict:
+    ''' Функция повтора состава исходного счета на целевом счете.
+
+       Состав целевого счета хранится в target['model'] и обновляется
+       по исполненным заявкам, только если все заявки цикла исполнены
+       полностью. Полное считывание позиций выполняется раз
+       в period_full_resync секунд, а при неполном исполнении заявок -
+       сразу и повторно в следующем цикле, так как заявки могут
+       исполниться после считывания.
+
+       Args:
+        target (dict): целевой счет (client, account_id, account, ratio)
+        account_source (PortfolioSnapshot): состав исходного счета
+
+        Returns:
+            dict: состав целевого счета, задания и невыполненные задания
+    '''
+
+    if target.get('client') is None:
+        raise target['connect_error']
+    # Ссылка на счет получается при первом успешном обращении
+    if target.get('account') is None:
+        target['account'] = get_account(target['client'], target['account_id'])
+    client_target, account_target = target['client'], target['account']
+    # Длительность этапов по целевому счету
+    timings = {}
+    labels = {'target': account_target.id}
+    # Полное считывание также после прерывания предыдущего цикла
+    # во время выставления заявок
+    if target.get('model') is None or target.get('dirty') \
+       or time.monotonic() - target['synced_at'] >= period_full_resync:
+        with metrics.timer('stage_duration_seconds', timings, stage='target_fetch', **labels):
+            target['synced_at'] = time.monotonic()
+            target['model'] = position_snapshot(client_target, account_target)
+            target['dirty'] = False
+    account_target_snapshot = target['model']
+    # Сведения об инструментах, находящихся на счетах
+    with metrics.timer('stage_duration_seconds', timings, stage='catalog_lookup', **labels):
+        df_dict_instr = catalog.lookup(client_target,
+                                       np.concatenate([account_source.figis(),
+                                                       account_target_snapshot.figis()]),
+                                       target['limits'].instruments
+                                       if target.get('limits') is not None else None)
+    # Сравнение исходного и целевого счетов и вычисление разницы
+    with metrics.timer('stage_duration_seconds', timings, stage='diff', **labels):
+        df_for_buy, df_for_sell = get_snapshot_difference(account_source,
+                                                          account_target_snapshot,
+                                                          target['ratio'],
+                                                          df_dict_instr)
+    # Отчеты об исполнении заявок
+    executed = []
+    target['dirty'] = True
+    # Выполнение заданий на продажу по рынку, продажи завершаются
+    # до начала покупок для высвобождения денежных средств
+    with metrics.timer('stage_duration_seconds', timings, stage='sell_orders', **labels):
+        df_not_sell = start_deal_tasks(client_target,
+                                       account_target,
+                                       df_for_sell,
+                                       False,
+                                       executed,
+                                       target.get('limits'),
+                                       target.get('pool'))
+    # Выполнение заданий на покупку по рынку
+    with metrics.timer('stage_duration_seconds', timings, stage='buy_orders', **labels):
+        df_not_buy = start_deal_tasks(client_target,
+                                      account_target,
+                                      df_for_buy,
+                                      True,
+                                      executed,
+                                      target.get('limits'),
+                                      target.get('pool'))
+    orders_done = time.monotonic()
+    if all(filled for _, _, filled in executed):
+        # Состояние целевого портфеля после выполнения заданий
+        # рассчитывается по отчетам об исполнении
+        target['model'] = account_target_snapshot.apply_executions(executed, df_dict_instr)
+        target['dirty'] = False
+    else:
+        # При неполном исполнении заявок - считывание состояния
+        # целевого портфеля. Заявки могут исполниться после считывания,
+        # поэтому в следующем цикле позиции считываются повторно
+        with metrics.timer('stage_duration_seconds', timings, stage='target_reread', **labels):
+            target['synced_at'] = time.monotonic()
+            target['model'] = position_snapshot(client_target, account_target)
+    return {'account_target': target['model'], 'df_dict_instr': df_dict_instr,
+            'df_for_buy': df_for_buy, 'df_for_sell': df_for_sell,
+            'df_not_buy': df_not_buy, 'df_not_sell': df_not_sell,
+            'target': account_target.id, 'timings': timings,
+            'orders_done': orders_done,
+            'executed': sum(1 for _, lots, _ in executed if lots != 0)}
+
+
+def record_cycle_metrics(results: list, timings: dict,
+                         detected_at: float, cycle_start: float) -> None:
+    ''' Функция учета метрик цикла сверки: количества заданий, отставания
+        от исходного счета и записи события цикла в журнал метрик.
+
+       Args:
+        results (list): результаты replicate_target по целевым счетам
+        timings (dict): длительность общих этапов цикла
+        detected_at (float): момент обнаружения изменения исходного счета
+        cycle_start (float): момент начала цикла
+    '''
+
+    metrics.observe('cycle_duration_seconds', time.monotonic() - cycle_start)
+    metrics.inc('cycles_total')
+    event = {'ts': time.time(), 'event': 'cycle', 'stages': timings, 'targets': []}
+    for result in results:
+        if 'error' in result:
+            event['targets'].append({'target': result['target'], 'error': str(result['error'])})
+            continue
+        labels = {'target': result['target']}
+        tasks = result['df_for_buy'].shape[0] + result['df_for_sell'].shape[0]
+        not_deal = result['df_not_buy'].shape[0] + result['df_not_sell'].shape[0]
+        metrics.set('pending_tasks', not_deal, **labels)
+        lag = None
+        # Отставание учитывается только в циклах, повторявших изменения
+        if tasks > 0:
+            lag = result['orders_done'] - detected_at
+            metrics.observe('replication_lag_seconds', lag, **labels)
+        event['targets'].append({'target': result['target'], 'stages': result['timings'],
+                                 'tasks': tasks, 'not_deal': not_deal, 'lag': lag})
+    if metrics_log is not None:
+        with open(metrics_log, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+
+def start_source_watchers(client: Client,
+                          account: Account,
+                          source_changed: threading.Event,
+                          stream_alive: threading.Event,
+                          stop: threading.Event = None) -> list:
+    ''' Функция запуска фоновых потоков, отслеживающих изменения исходного
+        счета по стримам позиций и сделок.
+
        Args:
         client (tinkoff.invest.Client):   клиент подключения TINKOFF INVEST API.
         account (tinkoff.invest.Account): счет TINKOFF INVEST API.
-        df_dict_instr (dict): словарь инструментов
+        source_changed (threading.Event): событие изменения исходного счета
+        stream_alive (threading.Event): событие доступности стрима позиций
+        stop (threading.Event): событие остановки потоков
 
         Returns:
-            pd.DataFrame: список открытых позиций
+            list: запущенные потоки
     '''
 
-    df_account = pd.DataFrame(columns=['id', 'Наименование', 'Количество', 'Тип актива'])
-    # Получение позиций
-    positions = client.operations.get_positions(account_id=account.id)
-    # Заполнение DataFrame исходного счета 
-    # Акции, фонды
-    for pos in positions.securities:
-        df_account = pd.concat([df_account,
-                                pd.DataFrame({'id': [pos.figi],
-                                              'Наименование': [df_dict_instr['name'].get(pos.figi, pos.figi)],
-                                              'Количество': [pos.balance],
-                                              'Тип актива': ['Акции, фонды']})],
-                                             ignore_index=True)
-    # Фьючерсы
-    for pos in positions.futures:
-        df_account = pd.concat([df_account,
-                                pd.DataFrame({'id': [pos.figi],
-                                              'Наименование': [df_dict_instr['name'].get(pos.figi, pos.figi)],
-                                              'Количество': [pos.balance],
-                                              'Тип актива': ['Фьючерсы']})],
-                                             ignore_index=True)
-    # Валюта
-    for pos in positions.money:
-        df_account = pd.concat([df_account,
-                                pd.DataFrame({'id': [pos.currency],
-                                              'Наименование': [df_dict_instr['name'].get(pos.currency, pos.currency)],
-                                              'Количество': [pos.units + pos.nano/1e9],
-                                              'Тип актива': ['Валюта']})],
-                                             ignore_index=True)
-    return df_account
+    # Стрим позиций определяет доступность режима, стрим сделок ускоряет
+    # реакцию на исполнение заявок на исходном счете
+    watchers = [(lambda: client.operations_stream.positions_stream(accounts=[account.id]),
+                 'position', stream_alive),
+                (lambda: client.orders_stream.trades_stream(accounts=[account.id]),
+                 'order_trades', None)]
+    threads = []
+    for open_stream, payload, alive in watchers:
+        thread = threading.Thread(target=watch_stream,
+                                  args=(open_stream, payload, source_changed, alive, stop),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def watch_stream(open_stream,
+                 payload: str,
+                 source_changed: threading.Event,
+                 stream_alive: threading.Event = None,
+                 stop: threading.Event = None) -> None:
+    ''' Функция чтения стрима, при получении сообщения с данными
+        устанавливается событие изменения счета. При обрыве стрима
+        сбрасывается событие доступности, основной цикл переходит
+        на периодический опрос, а стрим открывается повторно
+        с экспоненциально растущей задержкой.
+
+       Args:
+        open_stream (callable): функция открытия стрима
+        payload (str): поле сообщения стрима, содержащее изменения
+        source_changed (threading.Event): событие изменения исходного счета
+        stream_alive (threading.Event): событие доступности стрима
+        stop (threading.Event): событие остановки чтения стрима
+    '''
+
+    stop = stop or threading.Event()
+    attempt = 0
+    while not stop.is_set():
+        try:
+            for response in open_stream():
+                # Стрим доступен после получения первого сообщения (подтверждения
+                # подписки), так как открытие стрима gRPC не проверяет соединение
+                if stream_alive is not None and not stream_alive.is_set():
+                    stream_alive.set()
+                # Стрим работает - задержка переподключения сбрасывается
+                attempt = 0
+                # Сообщения ping и подтверждения подписки пропускаются
+                if getattr(response, payload, None) is not None:
+                    source_changed.set()
+            error = 'стрим завершен сервером'
+        except Exception as e:
+            error = e
+        if stream_alive is not None:
+            stream_alive.clear()
+        if stop.is_set():
+            break
+        metrics.inc('stream_reconnects_total', stream=payload)
+        print(f'Обрыв стрима {payload}: {error}', file=sys.stderr, flush=True)
+        # Внеочередная сверка после обрыва стрима
+        source_changed.set()
+        stop.wait(reconnect_delay(attempt))
+        attempt += 1
+
+
+def position_snapshot(client: Client, account: Account) -> PortfolioSnapshot:
+    ''' Функция получения состава счета.
+
+       Args:
+        client (tinkoff.invest.Client):   клиент подключения TINKOFF INVEST API.
+        account (tinkoff.invest.Account): счет TINKOFF INVEST API.
+
+        Returns:
+            PortfolioSnapshot: состав счета
+    '''
+
+    return PortfolioSnapshot.from_positions(client.operations.get_positions(account_id=account.id))
 
 
 def get_account_difference(df_account_source: pd.DataFrame, 
@@ -192,65 +972,105 @@ def get_account_difference(df_account_source: pd.DataFrame,
             pd.DataFrame: задание на продажу
     '''
     
-    df_for_buy = pd.DataFrame(columns=['id', 'Количество лотов', 'Тип актива'])
-    df_for_sell = pd.DataFrame(columns=['id', 'Количество лотов', 'Тип актива'])
+    return get_tasks(df_account_source['id'].to_numpy(dtype=object),
+                     df_account_source['Количество'].to_numpy(dtype=float),
+                     df_account_source['Тип актива'].to_numpy(dtype=object),
+                     df_account_target['id'].to_numpy(dtype=object),
+                     df_account_target['Количество'].to_numpy(dtype=float),
+                     df_account_target['Тип актива'].to_numpy(dtype=object),
+                     ratio_account,
+                     df_dict_instr)
+
+
+def get_snapshot_difference(account_source: PortfolioSnapshot,
+                            account_target: PortfolioSnapshot,
+                            ratio_account: float,
+                            df_dict_instr: pd.DataFrame) -> tuple:
+    ''' Функция получения заданий на покупку/продажу по составам счетов,
+        данные возвращаются в формате pandas.DataFrame.
+
+       Args:
+        account_source (PortfolioSnapshot): состав исходного счета
+        account_target (PortfolioSnapshot): состав целевого счета
+        ratio_account (float): коэффициент сделок
+        df_dict_instr (pd.DataFrame): словарь инструментов
+
+        Returns:
+            pd.DataFrame: задание на покупку
+            pd.DataFrame: задание на продажу
+    '''
+
+    return get_tasks(account_source.ids, account_source.amounts(), account_source.types(),
+                     account_target.ids, account_target.amounts(), account_target.types(),
+                     ratio_account,
+                     df_dict_instr)
+
+
+def get_tasks(ids_source: np.ndarray, amounts_source: np.ndarray, types_source: np.ndarray,
+              ids_target: np.ndarray, amounts_target: np.ndarray, types_target: np.ndarray,
+              ratio_account: float,
+              df_dict_instr: pd.DataFrame) -> tuple:
+    ''' Функция вычисления заданий на покупку/продажу по массивам позиций
+        исходного и целевого счетов (id, количество, тип актива).
+
+        Returns:
+            pd.DataFrame: задание на покупку
+            pd.DataFrame: задание на продажу
+    '''
+
     # Удаляем из аккаунтов rub
-    df_account_source = df_account_source.drop(df_account_source[df_account_source['id'] == 'rub'].index.tolist(), axis=0)
-    df_account_target = df_account_target.drop(df_account_target[df_account_target['id'] == 'rub'].index.tolist(), axis=0)
+    keep = ids_source != 'rub'
+    ids_source, amounts_source, types_source = ids_source[keep], amounts_source[keep], types_source[keep]
+    keep = ids_target != 'rub'
+    ids_target, amounts_target, types_target = ids_target[keep], amounts_target[keep], types_target[keep]
     # Переводим количество активов в количество лотов
-    df_account_source['Количество'] = df_account_source['Количество']//df_account_source['id'].map(df_dict_instr['lot'])
-    df_account_target['Количество'] = df_account_target['Количество']//df_account_target['id'].map(df_dict_instr['lot'])
+    lots_source = amounts_source // pd.Index(ids_source).map(df_dict_instr['lot']).to_numpy(dtype=float)
+    lots_target = amounts_target // pd.Index(ids_target).map(df_dict_instr['lot']).to_numpy(dtype=float)
     # Применяем коэффициент на количество лотов исходного счета 
-    df_account_source['Количество'] = df_account_source['Количество'] * ratio_account
-    df_account_source['Количество'] = df_account_source['Количество'].apply(lambda x: int(math.floor(x)))
+    lots_source = np.floor(lots_source * ratio_account)
+    # Лотность неизвестна для инструментов, отсутствующих в справочнике
+    unknown = np.isnan(lots_source)
+    if unknown.any():
+        raise ValueError('Нет сведений о лотности инструментов исходного счета: '
+                         + ', '.join(str(figi) for figi in ids_source[unknown]))
     
-    # Вычисление заданий на покупку/продажу
-    for i in df_account_source.index.to_list():
-        # Активы, которые есть на исходном счете и нет на целевом попадают в buy
-        id_source = df_account_source['id'].loc[i]
-        if df_account_target[df_account_target['id'] == id_source].shape[0] == 0:
-            df_for_buy = pd.concat([df_for_buy,
-                                    pd.DataFrame({'id': [df_account_source['id'].loc[i]],
-                                                  'Количество лотов': [df_account_source['Количество'].loc[i]],
-                                                  'Тип актива': [df_account_source['Тип актива'].loc[i]]})],
-                                                 ignore_index=True)
-        # Вычисление частичных открытий/закрытий
-        else:
-            count_lot_source = df_account_source['Количество'].loc[i]
-            count_lot_target = df_account_target[df_account_target['id'] == id_source]['Количество'].iloc[0]
-            if count_lot_source > count_lot_target:
-                df_for_buy = pd.concat([df_for_buy,
-                                        pd.DataFrame({'id': [df_account_source['id'].loc[i]],
-                                                      'Количество лотов': [count_lot_source - count_lot_target],
-                                                      'Тип актива': [df_account_source['Тип актива'].loc[i]]})],
-                                                    ignore_index=True)
-            elif count_lot_source < count_lot_target:
-                df_for_sell = pd.concat([df_for_sell,
-                                         pd.DataFrame({'id': [df_account_source['id'].loc[i]],
-                                                       'Количество лотов': [count_lot_target - count_lot_source],
-                                                       'Тип актива': [df_account_source['Тип актива'].loc[i]]})],
-                                                      ignore_index=True)
-                
-    # Активы, которых нет на исходном счете и есть на целевом попадают в sell
-    for i in df_account_target.index.to_list():
-        # Активы, которые есть на исходном счете и нет на целевом попадают в buy
-        id_target = df_account_target['id'].loc[i]
-        if df_account_source[df_account_source['id'] == id_target].shape[0] == 0:
-            df_for_sell = pd.concat([df_for_sell,
-                                     pd.DataFrame({'id': [df_account_target['id'].loc[i]],
-                                                   'Количество лотов': [df_account_target['Количество'].loc[i]],
-                                                   'Тип актива': [df_account_target['Тип актива'].loc[i]]})],
-                                                  ignore_index=True)
+    # Сопоставление позиций по id за один проход: для каждой позиции
+    # исходного счета - количество лотов первой такой же позиции целевого
+    in_target = pd.Index(ids_source).isin(ids_target)
+    in_source = pd.Index(ids_target).isin(ids_source)
+    lots_first = pd.Series(lots_target, index=ids_target)
+    lots_first = lots_first[~lots_first.index.duplicated()]
+    lots_matched = pd.Index(ids_source).map(lots_first).to_numpy(dtype=float)
+    # Активы, которые есть на исходном счете и нет на целевом, а также
+    # частичные открытия попадают в buy
+    mask_buy = ~in_target | (lots_source > lots_matched)
+    df_for_buy = pd.DataFrame({'id': ids_source[mask_buy],
+                               'Количество лотов': np.where(in_target, lots_source - lots_matched,
+                                                            lots_source)[mask_buy],
+                               'Тип актива': types_source[mask_buy]})
+    # Частичные закрытия, затем активы, которых нет на исходном счете
+    # и есть на целевом попадают в sell
+    mask_sell = in_target & (lots_source < lots_matched)
+    df_for_sell = pd.DataFrame({'id': np.concatenate([ids_source[mask_sell], ids_target[~in_source]]),
+                                'Количество лотов': np.concatenate([(lots_matched - lots_source)[mask_sell],
+                                                                    lots_target[~in_source]]),
+                                'Тип актива': np.concatenate([types_source[mask_sell], types_target[~in_source]])})
     # Очистка от нулевых значений (требуется, если коэффициент ratio_account < 1)
     df_for_sell = df_for_sell[df_for_sell['Количество лотов'] > 0]
     df_for_buy = df_for_buy[df_for_buy['Количество лотов'] > 0]
+    # Количество лотов - целое число
+    df_for_sell = df_for_sell.astype({'Количество лотов': 'int64'})
+    df_for_buy = df_for_buy.astype({'Количество лотов': 'int64'})
     return (df_for_buy, df_for_sell)
     
     
 def start_deal_tasks(client: Client, 
                      account: Account,
                      df_for_deal: pd.DataFrame,
-                     buy_sell: bool) -> pd.DataFrame:
+                     buy_sell: bool,
+                     executed: list = None,
+                     limits: 'RateLimits' = None,
+                     pool: ThreadPoolExecutor = None) -> pd.DataFrame:
     ''' Функция исполнения заданий на покупку/продажу, возвращается
         список неисполненных заданий в формате pandas.DataFrame.
        
@@ -259,64 +1079,453 @@ def start_deal_tasks(client: Client,
         account (tinkoff.invest.Account): счет TINKOFF INVEST API.
         df_for_deal (pd.DataFrame): задания на покупку
         buy_sell (bool): задания на продажу
+        executed (list): список для отчетов об исполнении заявок
+                         (id, количество лотов со знаком, признак полного исполнения)
+        limits (RateLimits): ограничители частоты запросов токена
+                             (по умолчанию без ограничения)
+        pool (ThreadPoolExecutor): пул потоков для отправки заявок
+                                   (по умолчанию создается на время вызова)
 
         Returns:
             pd.DataFrame: неисполненные задания
     '''
     
-    df_not_deal = pd.DataFrame(columns=['id', 'Количество лотов', 'Сообщение'])
-    # Продажа
-    for i in df_for_deal.index.to_list():
-        # Получение статуса торговли инструментом, 
-        # доступности исполнения заявки по рынку
-        resp_status = client.market_data.get_trading_status(figi=df_for_deal['id'].loc[i])
+    def deal(figi: str, lots: int) -> str:
+        # Статус торговли инструментом, доступность исполнения заявки по рынку
+        resp_status = statuses[figi]
         trading_status = resp_status.trading_status
         may_market = resp_status.market_order_available_flag
         if may_market and trading_status == SecurityTradingStatus.SECURITY_TRADING_STATUS_NORMAL_TRADING:
-            #===================================================================================================
             try:
                 # Исполнение ордера
-                order_response = client.orders.post_order(quantity=df_for_deal['Количество лотов'].loc[i],
-                                                          direction=OrderDirection.ORDER_DIRECTION_BUY if buy_sell else OrderDirection.ORDER_DIRECTION_SELL,
-                                                          account_id=account.id,
-                                                          order_type=OrderType.ORDER_TYPE_MARKET,
-                                                          instrument_id=df_for_deal['id'].loc[i])
+                if limits is not None:
+                    limits.orders.acquire()
+                with metrics.timer('order_round_trip_seconds', target=account.id):
+                    order_response = client.orders.post_order(quantity=lots,
+                                                              direction=OrderDirection.ORDER_DIRECTION_BUY if buy_sell else OrderDirection.ORDER_DIRECTION_SELL,
+                                                              account_id=account.id,
+                                                              order_type=OrderType.ORDER_TYPE_MARKET,
+                                                              instrument_id=figi)
+                metrics.inc('orders_placed_total', target=account.id, direction=direction)
                 # Получение статуса, сообщения
                 report_status, report_message = order_response.execution_report_status, order_response.message
-                # Если ордер не был исполнен, добавляем в неисполненные задания
-                if report_status != OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_FILL:
-                    df_not_deal = pd.concat([df_not_deal,
-                                             pd.DataFrame({'id': [df_for_deal['id'].loc[i]],
-                                                           'Количество лотов': [df_for_deal['Количество лотов'].loc[i]],
-                                                           'Сообщение': [f'Статус: {report_status}, сообщение: {report_message}']})],
-                                                          ignore_index=True)
+                if executed is not None:
+                    executed.append((figi,
+                                     order_response.lots_executed if buy_sell else -order_response.lots_executed,
+                                     report_status == OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_FILL))
             except Exception as e:
                 # Обработка исключений с более детальной информацией.
-                raise RuntimeError(f"Ошибка при размещении ордера для '{df_for_deal['id'].loc[i]}'. {e}.")
-            #===================================================================================================
+                raise RuntimeError(f"Ошибка при размещении ордера для '{figi}'. {e}.")
+            # Если ордер не был исполнен, добавляем в неисполненные задания
+            if report_status != OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_FILL:
+                return f'Статус: {report_status}, сообщение: {report_message}'
+            return None
         elif not may_market:
-            df_not_deal = pd.concat([df_not_deal,
-                                     pd.DataFrame({'id': [df_for_deal['id'].loc[i]],
-                                                   'Количество лотов': [df_for_deal['Количество лотов'].loc[i]],
-                                                   'Сообщение': ['Недоступно выставления рыночной заявки']})],
-                                                  ignore_index=True)
+            return 'Недоступно выставления рыночной заявки'
         else:
-            df_not_deal = pd.concat([df_not_deal,
-                                     pd.DataFrame({'id': [df_for_deal['id'].loc[i]],
-                                                   'Количество лотов': [df_for_deal['Количество лотов'].loc[i]],
-                                                   'Сообщение': ['Статус торгов отличен от нормального']})],
-                                                  ignore_index=True)
-    return df_not_deal
+            return 'Статус торгов отличен от нормального'
+
+    direction = 'buy' if buy_sell else 'sell'
+    # Независимые заявки отправляются параллельно, результаты собираются
+    # в порядке заданий
+    figis = df_for_deal['id'].to_list()
+    lots = [int(x) for x in df_for_deal['Количество лотов']]
+    # Статусы торговли запрашиваются одним запросом до отправки заявок
+    statuses = trading_statuses.get(client, figis,
+                                    limits.market_data if limits is not None else None)
+    if pool is not None:
+        messages = list(pool.map(deal, figis, lots))
+    else:
+        with ThreadPoolExecutor(max_workers=deal_workers) as executor:
+            messages = list(executor.map(deal, figis, lots))
+    not_deal = [(figi, count, message)
+                for figi, count, message in zip(figis, lots, messages)
+                if message is not None]
+    metrics.inc('orders_unfilled_total', len(not_deal), target=account.id, direction=direction)
+    return pd.DataFrame(not_deal, columns=['id', 'Количество лотов', 'Сообщение'])
+
+
+class TokenBucket:
+    ''' Ограничитель частоты запросов по алгоритму token bucket,
+        потокобезопасный.
+
+       Args:
+        rate (float): количество запросов в секунду
+        capacity (int): максимальное количество запросов подряд без ожидания
+    '''
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        ''' Функция ожидания разрешения на выполнение запроса. '''
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimits:
+    ''' Ограничители частоты запросов по сервисам API для одного токена. '''
+
+    def __init__(self):
+        self.orders = TokenBucket(orders_rate, deal_workers)
+        self.market_data = TokenBucket(market_data_rate, deal_workers)
+        # Лимит сервиса инструментов действует на минуту, поэтому допускается
+        # пакет запросов в пределах минутного лимита
+        self.instruments = TokenBucket(instruments_rate, max(deal_workers, int(instruments_rate * 60)))
+
+
+class TradingStatusCache:
+    ''' Кэш статусов торговли инструментами с коротким сроком
+        актуальности. Устаревшие и отсутствующие статусы запрашиваются
+        одним запросом get_trading_statuses.
+
+       Args:
+        ttl (float): срок актуальности статуса в секундах
+    '''
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # figi: (время получения, ответ get_trading_status)
+        self._statuses = {}
+        self._lock = threading.Lock()
+
+    def get(self, client: Client, figis: list, limiter: TokenBucket = None) -> dict:
+        ''' Функция получения статусов торговли инструментами.
+
+           Args:
+            client (tinkoff.invest.Client): клиент подключения TINKOFF INVEST API.
+            figis (list): список figi
+            limiter (TokenBucket): ограничитель частоты запросов токена клиента
+
+            Returns:
+                dict: статусы торговли по figi
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            expired = [figi for figi in dict.fromkeys(figis)
+                       if figi not in self._statuses
+                       or now - self._statuses[figi][0] >= self.ttl]
+        if expired:
+            if limiter is not None:
+                limiter.acquire()
+            response = client.market_data.get_trading_statuses(instrument_ids=expired)
+            with self._lock:
+                for status in response.trading_statuses:
+                    self._statuses[status.figi] = (now, status)
+        result = {}
+        for figi in figis:
+            with self._lock:
+                cached = self._statuses.get(figi)
+            if cached is None or now - cached[0] >= self.ttl:
+                # Инструмент отсутствует в пакетном ответе (в том числе
+                # при устаревшем статусе в кэше) - одиночный запрос
+                if limiter is not None:
+                    limiter.acquire()
+                cached = (now, client.market_data.get_trading_status(figi=figi))
+                with self._lock:
+                    self._statuses[figi] = cached
+            result[figi] = cached[1]
+        return result
+
+
+class SourceChange(threading.Event):
+    ''' Событие изменения исходного счета с отметкой момента первого
+        изменения после сброса.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.changed_at = None
+
+    def set(self) -> None:
+        if self.changed_at is None:
+            self.changed_at = time.monotonic()
+        super().set()
+
+    def clear(self) -> None:
+        self.changed_at = None
+        super().clear()
+
+
+class Metrics:
+    ''' Потокобезопасный реестр метрик: счетчики, текущие значения
+        и гистограммы с экспортом в текстовом формате Prometheus.
+    '''
+
+    # Границы интервалов гистограмм в секундах
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix: str = 'auto_following'):
+        self.prefix = prefix
+        self._counters = {}
+        self._gauges = {}
+        # (name, labels): [количество по интервалам, сумма, количество]
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, timings: dict = None, **labels):
+        ''' Замер длительности блока по монотонным часам с учетом
+            в гистограмме name. При передаче timings длительность также
+            сохраняется в нем по метке stage.
+        '''
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.observe(name, elapsed, **labels)
+            if timings is not None:
+                timings[labels.get('stage', name)] = elapsed
+
+    def prometheus(self) -> str:
+        ''' Функция формирования метрик в текстовом формате Prometheus.
+
+            Returns:
+                str: метрики
+        '''
+
+        def fmt(name, labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return f'{self.prefix}_{name}'
+            return f'{self.prefix}_{name}{{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+                    for (key, labels), value in values.items():
+                        if key == name:
+                            lines.append(f'{fmt(name, labels)} {value}')
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f'# TYPE {self.prefix}_{name} histogram')
+                for (key, labels), (counts, total, count) in self._histograms.items():
+                    if key != name:
+                        continue
+                    cumulative = 0
+                    for bound, n in zip(self.buckets, counts):
+                        cumulative += n
+                        lines.append(f"{fmt(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{fmt(name + '_bucket', labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{fmt(name + '_sum', labels)} {total}")
+                    lines.append(f"{fmt(name + '_count', labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    ''' Функция запуска HTTP-сервера экспорта метрик в фоновом потоке.
+
+       Args:
+        port (int): порт HTTP
+
+        Returns:
+            ThreadingHTTPServer: запущенный сервер
+    '''
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SessionScheduler:
+    ''' Расчет интервала опроса по расписанию торгов: во время торговых
+        сессий бирж инструментов, находящихся на счетах, используется
+        базовый период, во время сессий только других бирж - period_other_open,
+        вне сессий - period_closed, но не дольше, чем до начала ближайшей
+        сессии. Расписание запрашивается один раз в сутки.
+
+       Args:
+        period_closed (float): интервал опроса вне торговых сессий в секундах
+        period_other_open (float): интервал опроса во время сессий только
+                                   других бирж в секундах
+    '''
+
+    # Глубина запрашиваемого расписания
+    horizon = timedelta(days=7)
+
+    def __init__(self, period_closed: float, period_other_open: float):
+        self.period_closed = period_closed
+        self.period_other_open = period_other_open
+        self._day = None
+        # Торговые сессии по биржам: {биржа: [(начало, окончание)]}
+        self._sessions = {}
+
+    def delay(self, client: Client, period: float, exchanges=None) -> float:
+        ''' Функция расчета интервала до следующего опроса.
+
+           Args:
+            client (tinkoff.invest.Client): клиент подключения TINKOFF INVEST API.
+            period (float): интервал опроса во время торговых сессий
+            exchanges (iterable): биржи инструментов на счетах
+                                  (по умолчанию - все биржи)
+
+            Returns:
+                float: интервал в секундах
+        '''
+
+        now = datetime.now(timezone.utc)
+        if not self._load(client, now):
+            # Расписание недоступно - опрос с базовым периодом
+            return period
+        # Биржи, отсутствующие в расписании, не учитываются, если расписание
+        # не найдено ни для одной биржи - учитываются все
+        selected = [self._sessions[exchange] for exchange in set(exchanges or ())
+                    if exchange in self._sessions] or list(self._sessions.values())
+        sessions = [session for items in selected for session in items]
+        if any(start <= now < end for start, end in sessions):
+            return period
+        starts = [start for start, _ in sessions if start > now]
+        wait = self.period_closed
+        # Открыты только другие биржи - интервал сокращается
+        if any(start <= now < end for items in self._sessions.values() for start, end in items):
+            wait = min(wait, self.period_other_open)
+        if starts:
+            wait = min(wait, (min(starts) - now).total_seconds())
+        return max(period, wait)
+
+    def _load(self, client: Client, now: datetime) -> bool:
+        if self._day == now.date():
+            return True
+        try:
+            response = client.instruments.trading_schedules(from_=now, to=now + self.horizon)
+        except RequestError:
+            return False
+        sessions = {}
+        for exchange in response.exchanges:
+            items = sessions.setdefault(exchange.exchange, [])
+            for day in exchange.days:
+                if not day.is_trading_day:
+                    continue
+                # Вечерняя сессия продлевает торговый день
+                end = max(day.end_time, getattr(day, 'evening_end_time', None) or day.end_time)
+                items.append((day.start_time, end))
+        self._sessions = sessions
+        self._day = now.date()
+        return True
+
+
+# Коды ошибок gRPC, после которых достаточно переподключения
+transient_codes = {grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED,
+                   grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.INTERNAL,
+                   grpc.StatusCode.UNKNOWN, grpc.StatusCode.ABORTED,
+                   grpc.StatusCode.CANCELLED}
+
+
+def is_transient(error: BaseException) -> bool:
+    ''' Функция определения временной ошибки соединения с API по цепочке
+        исключений.
+
+       Args:
+        error (BaseException): исключение
+
+        Returns:
+            bool: признак временной ошибки
+    '''
+
+    while error is not None:
+        if isinstance(error, RequestError):
+            return error.code in transient_codes
+        if isinstance(error, grpc.RpcError):
+            return error.code() in transient_codes
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def reconnect_delay(attempt: int) -> float:
+    ''' Функция расчета задержки переподключения: экспоненциальный рост
+        с полным случайным разбросом.
+
+       Args:
+        attempt (int): номер попытки, начиная с 0
+
+        Returns:
+            float: задержка в секундах
+    '''
+
+    return random.uniform(0, min(reconnect_max, reconnect_base * 2 ** attempt))
+
+
+# Метрики работы скрипта
+metrics = Metrics()
+# Статусы торговли инструментами
+trading_statuses = TradingStatusCache(status_ttl)
     
 
 if __name__ == "__main__":
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    # Проверка списка целевых счетов до подключения
+    load_targets()
+    # Состояние, сохраняемое между переподключениями
+    state = {}
+    attempt = 0
     while True:
+        cycles = state.get('cycles', 0)
         try:
             try:
-                main()
+                main(state)
             except KeyboardInterrupt:
                 print('Работа скрипта остановлена...')
                 break
-        except Exception:
-            time.sleep(period_reload)
+        except Exception as e:
+            # Счетчик попыток сбрасывается, если после прошлой ошибки
+            # были выполнены циклы сверки
+            if state.get('cycles', 0) > cycles:
+                attempt = 0
+            metrics.inc('reconnects_total', transient=str(is_transient(e)).lower())
+            # При временной ошибке соединения - переподключение с сохранением
+            # состояния, иначе - полная инициализация
+            if not is_transient(e):
+                state.clear()
+            time.sleep(reconnect_delay(attempt))
+            attempt += 1
             continue
\ No newline at end of file
@@ -0,0 +1,159 @@
+'''Замер длительности этапов и выделения памяти цикла сверки на имитации брокера
+
+Пример запуска:
+    python benchmark.py --positions 10 100 1000 10000 --latency 0.001 --partial-fill 0.1
+'''
+import argparse
+import importlib.util
+import os
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_broker import FakeBroker
+
+
+def load_script(catalog_path: str):
+    ''' Функция загрузки модуля auto-following.py с настройками для замера:
+        без ограничения частоты запросов и с отдельным файлом справочника.
+
+       Args:
+        catalog_path (str): путь к файлу справочника инструментов
+
+        Returns:
+            module: модуль скрипта
+    '''
+
+    os.environ.setdefault("TOKEN_SOURCE", "fake")
+    os.environ.setdefault("TOKEN_TARGET", "fake")
+    os.environ.setdefault("period_reload", "1")
+    os.environ.setdefault("ratio_account", "1.0")
+    os.environ.setdefault("orders_rate", "1e9")
+    os.environ.setdefault("market_data_rate", "1e9")
+    os.environ.setdefault("instruments_rate", "1e9")
+    os.environ["catalog_path"] = catalog_path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'auto-following.py')
+    spec = importlib.util.spec_from_file_location('auto_following', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(stages: dict, name: str, memory: bool, func, *args):
+    ''' Функция выполнения этапа с замером времени и пикового выделения памяти.
+
+       Args:
+        stages (dict): накопленные замеры по этапам
+        name (str): наименование этапа
+        memory (bool): замер выделения памяти
+        func (callable): функция этапа
+
+        Returns:
+            результат функции этапа
+    '''
+
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    stages.setdefault(name, []).append((elapsed, peak))
+    return result
+
+
+def run_cycle(script, client_source, account_source,
+              target: dict, memory: bool) -> dict:
+    ''' Функция выполнения одного цикла сверки через replicate_target
+        с замерами: длительность этапов берется из timings результата,
+        пиковое выделение памяти замеряется по циклу целиком.
+
+       Args:
+        script (module): модуль скрипта
+        client_source (FakeClient): клиент исходного счета
+        account_source: исходный счет
+        target (dict): целевой счет в формате основного цикла
+        memory (bool): замер выделения памяти
+
+        Returns:
+            dict: замеры по этапам
+    '''
+
+    stages = {}
+    account_source_snapshot = measure(stages, 'source_fetch', memory,
+                                      script.position_snapshot, client_source, account_source)
+    # Счета возвращаются к исходному составу перед каждым циклом,
+    # поэтому позиции целевого счета считываются полностью
+    target['dirty'] = True
+    result = measure(stages, 'target_cycle', memory,
+                     script.replicate_target, target, account_source_snapshot)
+    if 'error' in result:
+        raise result['error']
+    for name, elapsed in result['timings'].items():
+        stages[name] = [(elapsed, 0)]
+    measure(stages, 'to_dataframe', memory,
+            result['account_target'].to_dataframe, result['df_dict_instr'])
+    stages['orders'] = [(0.0, result['df_for_buy'].shape[0] + result['df_for_sell'].shape[0])]
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--positions', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='количество позиций на счетах')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='задержка каждого запроса в секундах')
+    parser.add_argument('--partial-fill', type=float, default=0.0,
+                        help='вероятность частичного исполнения заявки')
+    parser.add_argument('--ratio', type=float, default=1.0,
+                        help='коэффициент пересчета размера позиций')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='количество замеряемых циклов')
+    parser.add_argument('--memory', action='store_true',
+                        help='замер пикового выделения памяти (замедляет выполнение)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script = load_script(os.path.join(tmp, 'instruments.npy'))
+        # Ограничители и пул потоков целевого счета, как в основном цикле
+        limits = script.RateLimits()
+        pool = ThreadPoolExecutor(max_workers=script.deal_workers)
+        for n_positions in args.positions:
+            broker = FakeBroker(n_instruments=max(2 * n_positions, 100),
+                                partial_fill=args.partial_fill)
+            broker.add_account('source', n_positions)
+            broker.add_account('target', n_positions)
+            client_source, client_target = broker.client('source'), broker.client('target')
+            account_source = client_source.users.get_accounts().accounts[0]
+            target = {'client': client_target,
+                      'account': client_target.users.get_accounts().accounts[0],
+                      'account_id': 'target', 'ratio': args.ratio, 'name': '',
+                      'limits': limits, 'pool': pool}
+            # Прогревочный цикл заполняет справочник инструментов
+            run_cycle(script, client_source, account_source, target, False)
+            broker.latency = args.latency
+            totals = {}
+            for _ in range(args.repeat):
+                broker.reset()
+                stages = run_cycle(script, client_source, account_source, target, args.memory)
+                for name, values in stages.items():
+                    totals.setdefault(name, []).extend(values)
+            orders = totals.pop('orders')[0][1]
+            cycle = totals.pop('target_cycle')
+            print(f'Позиций: {n_positions}, заявок за цикл: {orders}', '='*40)
+            print(f"{'этап':<16}{'среднее, мс':>14}{'мин, мс':>12}{'макс, мс':>12}")
+            for name, values in list(totals.items()) + [('цикл', cycle)]:
+                times = [elapsed * 1000 for elapsed, _ in values]
+                print(f'{name:<16}{sum(times) / len(times):>14.2f}'
+                      f'{min(times):>12.2f}{max(times):>12.2f}')
+            if args.memory:
+                print(f"{'пик памяти цикла, КБ':<28}{max(peak for _, peak in cycle) / 1024:>14.1f}")
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+'''Проверка совпадения заданий get_account_difference с исходной реализацией на случайных составах счетов
+
+Пример запуска:
+    python diff_check.py --portfolios 2000
+'''
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import warnings
+
+import pandas as pd
+
+from benchmark import load_script
+
+
+def get_account_difference_loop(df_account_source: pd.DataFrame,
+                                df_account_target: pd.DataFrame,
+                                ratio_account: float,
+                                df_dict_instr: pd.DataFrame) -> tuple:
+    ''' Исходная реализация get_account_difference (построчный проход
+        по позициям счетов), используется как эталон.
+
+       Args:
+        df_account_source (pd.DataFrame): состав исходного счета
+        df_account_target (pd.DataFrame): состав целевого счета
+        ratio_account (float): коэффициент сделок
+        df_dict_instr (pd.DataFrame): словарь инструментов
+
+        Returns:
+            pd.DataFrame: задание на покупку
+            pd.DataFrame: задание на продажу
+    '''
+
+    df_for_buy = pd.DataFrame(columns=['id', 'Количество лотов', 'Тип актива'])
+    df_for_sell = pd.DataFrame(columns=['id', 'Количество лотов', 'Тип актива'])
+    # Удаляем из аккаунтов rub
+    df_account_source = df_account_source.drop(df_account_source[df_account_source['id'] == 'rub'].index.tolist(), axis=0)
+    df_account_target = df_account_target.drop(df_account_target[df_account_target['id'] == 'rub'].index.tolist(), axis=0)
+    # Переводим количество активов в количество лотов
+    df_account_source['Количество'] = df_account_source['Количество']//df_account_source['id'].map(df_dict_instr['lot'])
+    df_account_target['Количество'] = df_account_target['Количество']//df_account_target['id'].map(df_dict_instr['lot'])
+    # Применяем коэффициент на количество лотов исходного счета
+    df_account_source['Количество'] = df_account_source['Количество'] * ratio_account
+    df_account_source['Количество'] = df_account_source['Количество'].apply(lambda x: int(math.floor(x)))
+
+    # Вычисление заданий на покупку/продажу
+    for i in df_account_source.index.to_list():
+        # Активы, которые есть на исходном счете и нет на целевом попадают в buy
+        id_source = df_account_source['id'].loc[i]
+        if df_account_target[df_account_target['id'] == id_source].shape[0] == 0:
+            df_for_buy = pd.concat([df_for_buy,
+                                    pd.DataFrame({'id': [df_account_source['id'].loc[i]],
+                                                  'Количество лотов': [df_account_source['Количество'].loc[i]],
+                                                  'Тип актива': [df_account_source['Тип актива'].loc[i]]})],
+                                                 ignore_index=True)
+        # Вычисление частичных открытий/закрытий
+        else:
+            count_lot_source = df_account_source['Количество'].loc[i]
+            count_lot_target = df_account_target[df_account_target['id'] == id_source]['Количество'].iloc[0]
+            if count_lot_source > count_lot_target:
+                df_for_buy = pd.concat([df_for_buy,
+                                        pd.DataFrame({'id': [df_account_source['id'].loc[i]],
+                                                      'Количество лотов': [count_lot_source - count_lot_target],
+                                                      'Тип актива': [df_account_source['Тип актива'].loc[i]]})],
+                                                    ignore_index=True)
+            elif count_lot_source < count_lot_target:
+                df_for_sell = pd.concat([df_for_sell,
+                                         pd.DataFrame({'id': [df_account_source['id'].loc[i]],
+                                                       'Количество лотов': [count_lot_target - count_lot_source],
+                                                       'Тип актива': [df_account_source['Тип актива'].loc[i]]})],
+                                                      ignore_index=True)
+
+    # Активы, которых нет на исходном счете и есть на целевом попадают в sell
+    for i in df_account_target.index.to_list():
+        id_target = df_account_target['id'].loc[i]
+        if df_account_source[df_account_source['id'] == id_target].shape[0] == 0:
+            df_for_sell = pd.concat([df_for_sell,
+                                     pd.DataFrame({'id': [df_account_target['id'].loc[i]],
+                                                   'Количество лотов': [df_account_target['Количество'].loc[i]],
+                                                   'Тип актива': [df_account_target['Тип актива'].loc[i]]})],
+                                                  ignore_index=True)
+    # Очистка от нулевых значений (требуется, если коэффициент ratio_account < 1)
+    df_for_sell = df_for_sell[df_for_sell['Количество лотов'] > 0]
+    df_for_buy = df_for_buy[df_for_buy['Количество лотов'] > 0]
+    return (df_for_buy, df_for_sell)
+
+
+def random_account(rnd: random.Random, ids: list, lots: dict) -> pd.DataFrame:
+    ''' Функция формирования случайного состава счета: часть инструментов
+        справочника с количеством, не всегда кратным лоту, и остаток рублей.
+
+       Args:
+        rnd (random.Random): генератор случайных чисел
+        ids (list): id инструментов справочника
+        lots (dict): лотность инструментов
+
+        Returns:
+            pd.DataFrame: состав счета
+    '''
+
+    rows = []
+    for figi in rnd.sample(ids, rnd.randint(0, len(ids))):
+        rows.append((figi, figi,
+                     rnd.randint(0, 50) * lots[figi] + rnd.randint(0, lots[figi] - 1),
+                     'Акции, фонды' if figi[0] == 'S' else 'Фьючерсы'))
+    if rnd.random() < 0.7:
+        rows.append(('rub', 'rub', rnd.random() * 1e5, 'Валюта'))
+    rnd.shuffle(rows)
+    return pd.DataFrame(rows, columns=['id', 'Наименование', 'Количество', 'Тип актива'])
+
+
+def same_tasks(df_expected: pd.DataFrame, df_actual: pd.DataFrame) -> bool:
+    ''' Функция сравнения заданий: порядок, id, тип актива и количество лотов. '''
+
+    return (list(df_expected.index) == list(df_actual.index)
+            and list(df_expected['id']) == list(df_actual['id'])
+            and list(df_expected['Тип актива']) == list(df_actual['Тип актива'])
+            and [float(x) for x in df_expected['Количество лотов']]
+                == [float(x) for x in df_actual['Количество лотов']])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--portfolios', type=int, default=2000,
+                        help='количество случайных пар счетов')
+    args = parser.parse_args()
+    # Исходная реализация дополняет пустые таблицы через pd.concat
+    warnings.simplefilter('ignore', FutureWarning)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script = load_script(os.path.join(tmp, 'instruments.npy'))
+    failed = []
+    for seed in range(args.portfolios):
+        rnd = random.Random(seed)
+        ids = [f'S{i}' for i in range(rnd.randint(1, 30))] + [f'F{i}' for i in range(rnd.randint(0, 5))]
+        lots = {figi: rnd.choice([1, 1, 10, 100]) for figi in ids}
+        df_dict_instr = pd.DataFrame({'lot': lots})
+        df_account_source = random_account(rnd, ids, lots)
+        df_account_target = random_account(rnd, ids, lots)
+        ratio = rnd.choice([0.3, 0.5, 1.0, 2.5, 3.7])
+        expected = get_account_difference_loop(df_account_source, df_account_target,
+                                               ratio, df_dict_instr)
+        actual = script.get_account_difference(df_account_source, df_account_target,
+                                               ratio, df_dict_instr)
+        if not all(same_tasks(e, a) for e, a in zip(expected, actual)):
+            failed.append(seed)
+    print(f'Пар счетов: {args.portfolios}, расхождений: {len(failed)}')
+    if failed:
+        print('Начальные значения с расхождениями:', ', '.join(map(str, failed[:20])))
+
+    # Инструмент исходного счета без сведений о лотности
+    df_account = pd.DataFrame([('S0', 'S0', 10, 'Акции, фонды')],
+                              columns=['id', 'Наименование', 'Количество', 'Тип актива'])
+    try:
+        script.get_account_difference(df_account, df_account.iloc[:0], 1.0,
+                                      pd.DataFrame({'lot': {'S1': 1}}))
+        named = False
+    except ValueError as e:
+        named = 'S0' in str(e)
+    print('Ошибка при отсутствии лотности содержит id:', 'да' if named else 'нет')
+    sys.exit(0 if not failed and named else 1)
+
+
+if __name__ == "__main__":
+    main()
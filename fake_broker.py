@@ -0,0 +1,355 @@
+'''Имитация брокера для локального прогона цикла сверки без обращения к API'''
+import queue
+import random
+import threading
+import time
+from datetime import datetime, time as day_time, timedelta, timezone
+from types import SimpleNamespace
+
+import grpc
+from tinkoff.invest import SecurityTradingStatus, RequestError
+from tinkoff.invest import OrderExecutionReportStatus, OrderDirection
+
+
+class FakeBroker:
+    ''' Общее состояние имитируемого брокера: справочник инструментов
+        и позиции счетов. Один экземпляр используется всеми клиентами,
+        как и настоящий брокер.
+
+       Args:
+        n_instruments (int): количество инструментов в справочнике
+        latency (float): задержка каждого запроса в секундах
+        partial_fill (float): вероятность частичного исполнения заявки
+        seed (int): начальное значение генератора случайных чисел
+    '''
+
+    def __init__(self, n_instruments: int, latency: float = 0.0,
+                 partial_fill: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.partial_fill = partial_fill
+        self.random = random.Random(seed)
+        self.instruments = {}
+        for i in range(n_instruments):
+            instrument_type = self.random.choice(['share', 'share', 'bond', 'etf', 'futures'])
+            figi = f'BBG{i:09d}'
+            self.instruments[figi] = SimpleNamespace(
+                figi=figi,
+                name=f'Инструмент {i}',
+                ticker=f'T{i}',
+                class_code='TQBR',
+                uid=f'uid-{i}',
+                instrument_type=instrument_type,
+                min_price_increment=SimpleNamespace(units=0, nano=10000000),
+                lot=self.random.choice([1, 1, 10, 100]),
+                trading_status=SecurityTradingStatus.SECURITY_TRADING_STATUS_NORMAL_TRADING,
+                api_trade_available_flag=True,
+                currency='rub',
+                exchange='MOEX',
+                buy_available_flag=True,
+                sell_available_flag=True,
+                short_enabled_flag=False,
+                klong=SimpleNamespace(units=2, nano=0),
+                kshort=SimpleNamespace(units=2, nano=0),
+            )
+        # Расписание торгов по биржам: {биржа: (начало, окончание)} по UTC,
+        # торговые дни - с понедельника по пятницу
+        self.schedule = {'MOEX': (day_time(7, 0), day_time(20, 50)),
+                         'SPB': (day_time(4, 0), day_time(22, 0))}
+        # account_id: {figi: количество}
+        self.accounts = {}
+        self._initial = {}
+        # Очереди сообщений открытых стримов: (поле сообщения, счета, очередь)
+        self._streams = []
+        self._lock = threading.Lock()
+
+    def add_account(self, account_id: str, n_positions: int, money: float = 1e9) -> None:
+        ''' Функция создания счета со случайным составом.
+
+           Args:
+            account_id (str): идентификатор счета
+            n_positions (int): количество позиций
+            money (float): остаток рублей на счете
+        '''
+
+        figis = self.random.sample(sorted(self.instruments), n_positions)
+        positions = {figi: self.random.randint(1, 50) * self.instruments[figi].lot
+                     for figi in figis}
+        positions['rub'] = money
+        self._initial[account_id] = dict(positions)
+        self.accounts[account_id] = positions
+
+    def reset(self) -> None:
+        ''' Функция возврата счетов к исходному составу. '''
+
+        with self._lock:
+            self.accounts = {account_id: dict(positions)
+                             for account_id, positions in self._initial.items()}
+
+    def set_position(self, account_id: str, figi: str, balance: float) -> None:
+        ''' Функция изменения позиции счета в обход заявок (например, сделка
+            на исходном счете), изменение отправляется в стрим позиций.
+
+           Args:
+            account_id (str): идентификатор счета
+            figi (str): figi инструмента
+            balance (float): новое количество
+        '''
+
+        with self._lock:
+            if balance:
+                self.accounts[account_id][figi] = balance
+            else:
+                self.accounts[account_id].pop(figi, None)
+        self.notify(account_id, 'position',
+                    SimpleNamespace(account_id=account_id, figi=figi, balance=balance))
+
+    def notify(self, account_id: str, payload: str, data) -> None:
+        ''' Функция отправки сообщения в открытые стримы счета.
+
+           Args:
+            account_id (str): идентификатор счета
+            payload (str): поле сообщения стрима (position, order_trades)
+            data: содержимое сообщения
+        '''
+
+        with self._lock:
+            streams = list(self._streams)
+        for stream_payload, accounts, messages in streams:
+            if stream_payload == payload and account_id in accounts:
+                messages.put(SimpleNamespace(**{payload: data}))
+
+    def drop_streams(self) -> None:
+        ''' Функция обрыва всех открытых стримов с ошибкой UNAVAILABLE. '''
+
+        with self._lock:
+            streams = list(self._streams)
+        for _, _, messages in streams:
+            messages.put(None)
+
+    def subscribe(self, payload: str, accounts: list) -> queue.Queue:
+        ''' Функция регистрации подписки на сообщения стрима. В очередь
+            поступают сообщения notify, при обрыве стримов - None.
+
+           Args:
+            payload (str): поле сообщения стрима
+            accounts (list): идентификаторы счетов подписки
+
+            Returns:
+                queue.Queue: очередь сообщений
+        '''
+
+        messages = queue.Queue()
+        with self._lock:
+            self._streams.append((payload, set(accounts), messages))
+        return messages
+
+    def unsubscribe(self, messages: queue.Queue) -> None:
+        ''' Функция отмены подписки на сообщения стрима.
+
+           Args:
+            messages (queue.Queue): очередь сообщений подписки
+        '''
+
+        with self._lock:
+            self._streams = [entry for entry in self._streams if entry[2] is not messages]
+
+    def stream(self, payload: str, accounts: list):
+        ''' Функция открытия стрима в процессе, без gRPC: подписка
+            регистрируется сразу, сообщения (подтверждение подписки, затем
+            сообщения notify до обрыва стрима) возвращаются генератором.
+
+           Args:
+            payload (str): поле сообщения стрима
+            accounts (list): идентификаторы счетов подписки
+
+            Returns:
+                generator: сообщения стрима
+        '''
+
+        self.wait()
+        messages = self.subscribe(payload, accounts)
+        return self._read_stream(messages, accounts)
+
+    def _read_stream(self, messages: queue.Queue, accounts: list):
+        try:
+            yield SimpleNamespace(subscriptions=SimpleNamespace(accounts=list(accounts)))
+            while True:
+                message = messages.get()
+                if message is None:
+                    raise RequestError(grpc.StatusCode.UNAVAILABLE, 'Stream dropped', None)
+                yield message
+        finally:
+            self.unsubscribe(messages)
+
+    def client(self, account_id: str) -> 'FakeClient':
+        ''' Функция получения клиента с доступом к счету.
+
+           Args:
+            account_id (str): идентификатор счета
+
+            Returns:
+                FakeClient: клиент подключения
+        '''
+
+        return FakeClient(self, account_id)
+
+    def wait(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+class FakeClient:
+    ''' Клиент, повторяющий интерфейс tinkoff.invest.Client в объеме,
+        используемом скриптом: users, instruments, operations,
+        market_data, orders, operations_stream, orders_stream.
+    '''
+
+    def __init__(self, broker: FakeBroker, account_id: str):
+        self.users = _Users(broker, account_id)
+        self.instruments = _Instruments(broker)
+        self.operations = _Operations(broker)
+        self.market_data = _MarketData(broker)
+        self.orders = _Orders(broker)
+        self.operations_stream = _OperationsStream(broker)
+        self.orders_stream = _OrdersStream(broker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Users:
+    def __init__(self, broker: FakeBroker, account_id: str):
+        self.broker = broker
+        self.account_id = account_id
+
+    def get_accounts(self):
+        self.broker.wait()
+        return SimpleNamespace(accounts=[SimpleNamespace(id=self.account_id)])
+
+
+class _Instruments:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    def get_instrument_by(self, id_type, id):
+        self.broker.wait()
+        if id not in self.broker.instruments:
+            raise RequestError(grpc.StatusCode.NOT_FOUND, 'Instrument not found', None)
+        return SimpleNamespace(instrument=self.broker.instruments[id])
+
+    def trading_schedules(self, from_: datetime, to: datetime, exchange: str = None):
+        self.broker.wait()
+        exchanges = []
+        for name, (start, end) in self.broker.schedule.items():
+            if exchange is not None and name != exchange:
+                continue
+            days = []
+            date = from_.date()
+            while date <= to.date():
+                days.append(SimpleNamespace(
+                    date=datetime.combine(date, day_time(0, 0), tzinfo=timezone.utc),
+                    is_trading_day=date.weekday() < 5,
+                    start_time=datetime.combine(date, start, tzinfo=timezone.utc),
+                    end_time=datetime.combine(date, end, tzinfo=timezone.utc),
+                    evening_end_time=None,
+                ))
+                date += timedelta(days=1)
+            exchanges.append(SimpleNamespace(exchange=name, days=days))
+        return SimpleNamespace(exchanges=exchanges)
+
+
+class _Operations:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    def get_positions(self, account_id: str):
+        self.broker.wait()
+        with self.broker._lock:
+            positions = dict(self.broker.accounts[account_id])
+        securities, futures, money = [], [], []
+        for figi, balance in positions.items():
+            if figi not in self.broker.instruments:
+                money.append(SimpleNamespace(currency=figi, units=int(balance),
+                                             nano=int(round(balance % 1 * 1e9))))
+            elif self.broker.instruments[figi].instrument_type == 'futures':
+                futures.append(SimpleNamespace(figi=figi, balance=balance))
+            else:
+                securities.append(SimpleNamespace(figi=figi, balance=balance))
+        return SimpleNamespace(securities=securities, futures=futures, money=money)
+
+
+class _MarketData:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    def _status(self, figi: str):
+        return SimpleNamespace(
+            figi=figi,
+            trading_status=SecurityTradingStatus.SECURITY_TRADING_STATUS_NORMAL_TRADING,
+            market_order_available_flag=True,
+        )
+
+    def get_trading_status(self, figi: str):
+        self.broker.wait()
+        return self._status(figi)
+
+    def get_trading_statuses(self, instrument_ids: list):
+        self.broker.wait()
+        return SimpleNamespace(trading_statuses=[self._status(figi) for figi in instrument_ids])
+
+
+class _Orders:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    def post_order(self, quantity: int, direction, account_id: str,
+                   order_type, instrument_id: str):
+        self.broker.wait()
+        with self.broker._lock:
+            # Частичное исполнение заявки с заданной вероятностью
+            lots_executed = quantity
+            if quantity > 1 and self.broker.random.random() < self.broker.partial_fill:
+                lots_executed = self.broker.random.randint(1, quantity - 1)
+            sign = 1 if direction == OrderDirection.ORDER_DIRECTION_BUY else -1
+            positions = self.broker.accounts[account_id]
+            balance = positions.get(instrument_id, 0) \
+                      + sign * lots_executed * self.broker.instruments[instrument_id].lot
+            if balance:
+                positions[instrument_id] = balance
+            else:
+                positions.pop(instrument_id, None)
+        if lots_executed:
+            self.broker.notify(account_id, 'order_trades',
+                               SimpleNamespace(account_id=account_id, figi=instrument_id,
+                                               direction=direction))
+            self.broker.notify(account_id, 'position',
+                               SimpleNamespace(account_id=account_id, figi=instrument_id,
+                                               balance=balance))
+        status = OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_FILL \
+                 if lots_executed == quantity \
+                 else OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_PARTIALLYFILL
+        return SimpleNamespace(figi=instrument_id,
+                               direction=direction,
+                               lots_requested=quantity,
+                               lots_executed=lots_executed,
+                               execution_report_status=status,
+                               message='')
+
+
+class _OperationsStream:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    def positions_stream(self, accounts: list):
+        return self.broker.stream('position', accounts)
+
+
+class _OrdersStream:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    def trades_stream(self, accounts: list):
+        return self.broker.stream('order_trades', accounts)
@@ -0,0 +1,122 @@
+'''Локальный gRPC-сервер стримов позиций и сделок имитации брокера для проверки режима стрима через клиент TINKOFF INVEST API'''
+import os
+import subprocess
+import tempfile
+from concurrent import futures
+
+import grpc
+from tinkoff.invest.grpc import common_pb2, operations_pb2, orders_pb2
+
+from fake_broker import FakeBroker
+
+
+# Пакет сервисов TINKOFF INVEST API
+service_prefix = 'tinkoff.public.invest.api.contract.v1.'
+
+
+class FakeStreamServer:
+    ''' gRPC-сервер на localhost, реализующий OperationsStreamService.PositionsStream
+        и OrdersStreamService.TradesStream по сообщениям имитации брокера
+        (FakeBroker.notify, обрыв - FakeBroker.drop_streams). Клиент
+        TINKOFF INVEST API подключается только по TLS, поэтому сервер
+        использует самоподписанный сертификат, создаваемый openssl при
+        запуске. Для доверия клиента к сертификату путь к нему (cert_path)
+        задается в переменной окружения GRPC_DEFAULT_SSL_ROOTS_FILE_PATH
+        до создания первого защищенного канала. Остальные сервисы API
+        сервером не реализуются.
+
+       Args:
+        broker (FakeBroker): имитация брокера
+        workers (int): количество потоков обработки запросов
+    '''
+
+    def __init__(self, broker: FakeBroker, workers: int = 8):
+        self.broker = broker
+        self._dir = tempfile.TemporaryDirectory()
+        self.cert_path = os.path.join(self._dir.name, 'localhost.pem')
+        key_path = os.path.join(self._dir.name, 'localhost.key')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                        '-keyout', key_path, '-out', self.cert_path, '-days', '1',
+                        '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost'],
+                       check=True, capture_output=True)
+        with open(key_path, 'rb') as f:
+            key = f.read()
+        with open(self.cert_path, 'rb') as f:
+            cert = f.read()
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+        self._server.add_generic_rpc_handlers([
+            grpc.method_handlers_generic_handler(service_prefix + 'OperationsStreamService', {
+                'PositionsStream': grpc.unary_stream_rpc_method_handler(
+                    self._positions_stream,
+                    request_deserializer=operations_pb2.PositionsStreamRequest.FromString,
+                    response_serializer=operations_pb2.PositionsStreamResponse.SerializeToString),
+            }),
+            grpc.method_handlers_generic_handler(service_prefix + 'OrdersStreamService', {
+                'TradesStream': grpc.unary_stream_rpc_method_handler(
+                    self._trades_stream,
+                    request_deserializer=orders_pb2.TradesStreamRequest.FromString,
+                    response_serializer=orders_pb2.TradesStreamResponse.SerializeToString),
+            }),
+        ])
+        port = self._server.add_secure_port('localhost:0',
+                                            grpc.ssl_server_credentials([(key, cert)]))
+        # Адрес сервера для параметра invest_target (target клиента)
+        self.target = f'localhost:{port}'
+
+    def start(self) -> 'FakeStreamServer':
+        self._server.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.stop(grace=None)
+        self._dir.cleanup()
+
+    def _subscribe(self, payload: str, accounts: list, context):
+        # Подписка регистрируется до отправки подтверждения, чтобы клиент
+        # получил все сообщения после подтверждения
+        messages = self.broker.subscribe(payload, accounts)
+        context.add_callback(lambda: messages.put(None))
+        return messages
+
+    def _payloads(self, messages, payload: str, context):
+        # Сообщения до отмены вызова клиентом либо обрыва стримов
+        while True:
+            message = messages.get()
+            if message is None:
+                if context.is_active():
+                    context.abort(grpc.StatusCode.UNAVAILABLE, 'Stream dropped')
+                return
+            yield getattr(message, payload)
+
+    def _positions_stream(self, request, context):
+        accounts = list(request.accounts)
+        messages = self._subscribe('position', accounts, context)
+        try:
+            yield operations_pb2.PositionsStreamResponse(
+                subscriptions=operations_pb2.PositionsSubscriptionResult(
+                    accounts=[operations_pb2.PositionsSubscriptionStatus(account_id=account_id)
+                              for account_id in accounts]))
+            for data in self._payloads(messages, 'position', context):
+                position = operations_pb2.PositionData(account_id=data.account_id)
+                if self.broker.instruments[data.figi].instrument_type == 'futures':
+                    position.futures.append(operations_pb2.PositionsFutures(
+                        figi=data.figi, balance=int(data.balance)))
+                else:
+                    position.securities.append(operations_pb2.PositionsSecurities(
+                        figi=data.figi, balance=int(data.balance)))
+                yield operations_pb2.PositionsStreamResponse(position=position)
+        finally:
+            self.broker.unsubscribe(messages)
+
+    def _trades_stream(self, request, context):
+        accounts = list(request.accounts)
+        messages = self._subscribe('order_trades', accounts, context)
+        try:
+            yield orders_pb2.TradesStreamResponse(ping=common_pb2.Ping())
+            for data in self._payloads(messages, 'order_trades', context):
+                yield orders_pb2.TradesStreamResponse(
+                    order_trades=orders_pb2.OrderTrades(account_id=data.account_id,
+                                                        figi=data.figi,
+                                                        direction=int(data.direction)))
+        finally:
+            self.broker.unsubscribe(messages)
@@ -0,0 +1,116 @@
+'''Проверка режима стрима на имитации брокера: сообщение стрима исходного счета вызывает сверку, после обрыва стрим открывается повторно
+
+Стримы читаются клиентом TINKOFF INVEST API с локального gRPC-сервера
+fake_stream_server.py (требуется openssl), с параметром --transport inprocess -
+напрямую из имитации брокера без gRPC.
+
+Пример запуска:
+    python stream_check.py --transport grpc
+'''
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+
+from benchmark import load_script
+from fake_broker import FakeBroker
+
+
+# Время ожидания событий в секундах
+timeout = 5
+
+
+def check(name: str, condition: bool) -> bool:
+    ''' Функция вывода результата проверки.
+
+       Args:
+        name (str): наименование проверки
+        condition (bool): результат проверки
+
+        Returns:
+            bool: результат проверки
+    '''
+
+    print(f"{'OK  ' if condition else 'FAIL'} {name}", flush=True)
+    return condition
+
+
+def wait_until(condition) -> bool:
+    ''' Функция ожидания выполнения условия не дольше timeout секунд. '''
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--transport', choices=['grpc', 'inprocess'], default='grpc',
+                        help='источник стримов: локальный gRPC-сервер или имитация брокера')
+    args = parser.parse_args()
+    # Короткие задержки переподключения стрима
+    os.environ.setdefault("reconnect_base", "0.05")
+    os.environ.setdefault("reconnect_max", "0.2")
+    with tempfile.TemporaryDirectory() as tmp, ExitStack() as stack:
+        script = load_script(os.path.join(tmp, 'instruments.npy'))
+        broker = FakeBroker(n_instruments=100)
+        broker.add_account('source', 10)
+        broker.add_account('target', 10)
+        client_source, client_target = broker.client('source'), broker.client('target')
+        account_source = client_source.users.get_accounts().accounts[0]
+        target = {'client': client_target,
+                  'account': client_target.users.get_accounts().accounts[0],
+                  'ratio': 1.0, 'name': ''}
+        source_changed = script.SourceChange()
+        stream_alive = threading.Event()
+        stop = threading.Event()
+        client_stream = client_source
+        if args.transport == 'grpc':
+            from fake_stream_server import FakeStreamServer
+            server = FakeStreamServer(broker).start()
+            stack.callback(server.stop)
+            # Доверие клиента к самоподписанному сертификату сервера
+            os.environ['GRPC_DEFAULT_SSL_ROOTS_FILE_PATH'] = server.cert_path
+            client_stream = stack.enter_context(script.Client(script.TOKEN_SOURCE,
+                                                              target=server.target))
+        # При завершении потоки стримов останавливаются до закрытия стримов
+        stack.callback(broker.drop_streams)
+        stack.callback(stop.set)
+        script.start_source_watchers(client_stream, account_source,
+                                     source_changed, stream_alive, stop)
+        ok = check('стрим позиций открыт', stream_alive.wait(timeout))
+        # Начальная сверка счетов
+        script.replicate_target(target, script.position_snapshot(client_source, account_source))
+        source_changed.clear()
+
+        # Сделка на исходном счете
+        figi = next(figi for figi in broker.instruments if figi not in broker.accounts['source'])
+        broker.set_position('source', figi, 3 * broker.instruments[figi].lot)
+        ok &= check('сообщение стрима вызывает сверку', source_changed.wait(timeout))
+        source_changed.clear()
+        script.replicate_target(target, script.position_snapshot(client_source, account_source))
+        ok &= check('сверка повторяет сделку на целевом счете',
+                    broker.accounts['target'].get(figi) == broker.accounts['source'][figi])
+        ok &= check('заявки целевого счета не вызывают сверку', not source_changed.is_set())
+
+        # Обрыв стримов
+        broker.drop_streams()
+        ok &= check('обрыв стрима вызывает сверку', source_changed.wait(timeout))
+        ok &= check('стрим позиций открыт повторно',
+                    wait_until(lambda: 'stream_reconnects_total{stream="position"} 1'
+                                       in script.metrics.prometheus())
+                    and stream_alive.wait(timeout))
+        source_changed.clear()
+        broker.set_position('source', figi, 0)
+        ok &= check('сообщение после переподключения вызывает сверку', source_changed.wait(timeout))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()